@@ -0,0 +1,224 @@
+"""
+Benchmark the stages of the color pipeline on synthetic images
+    Times ColorCube.find_local_maxima, ColorCube.filter_distinct_maxima,
+    ImageCrop.crop_image, get_nearest_color and color_main.main separately
+    and writes the timings as JSON
+    Arguments:
+        output - json file to write results to (printed if not given)
+        sizes - side lengths of the synthetic images
+        resolutions - color cube resolutions to time
+        image_counts - number of images in the dirs passed to color_main.main
+        repeat - number of timed runs of each benchmark, the fastest one counts
+        compare - json file of an earlier run, timings are compared against it
+        tolerance - relative slowdown that counts as regression in compare mode
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import color_main
+from colorcube.colorcube import ColorCube
+from config.args import get_args
+from config.constants import color_list
+from crop.imagecrop import ImageCrop
+from utils.color_functions import get_nearest_color
+
+# kinds of synthetic images, see make_image
+IMAGE_KINDS = ("flat", "gradient", "noise", "bordered", "rgba")
+
+
+def make_image(kind, size, seed=0):
+    """
+    Return a synthetic size x size uint8 image
+        flat: a few large areas of solid color
+        gradient: smooth gradients over all color components
+        noise: uniform random colors (worst case for the color cube)
+        bordered: noisy object on a black background, as produced by segmentation
+        rgba: gradient with a varying alpha channel
+    """
+    rng = np.random.default_rng(seed)
+    if kind == "flat":
+        colors = rng.integers(0, 256, (4, 3), dtype=np.uint8)
+        areas = (np.arange(size)[:, None] * 2 // size) * 2 + np.arange(size) * 2 // size
+        return colors[areas]
+    ramp = np.linspace(0, 255, size)
+    gradient = np.stack(
+        (
+            np.broadcast_to(ramp[:, None], (size, size)),
+            np.broadcast_to(ramp[None, :], (size, size)),
+            np.broadcast_to(ramp[::-1, None], (size, size)),
+        ),
+        axis=2,
+    ).astype(np.uint8)
+    if kind == "gradient":
+        return gradient
+    if kind == "noise":
+        return rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    if kind == "bordered":
+        image = np.zeros((size, size, 3), dtype=np.uint8)
+        border = size // 5
+        inner = size - 2 * border
+        image[border:-border, border:-border] = np.clip(
+            gradient[:inner, :inner] + rng.integers(-20, 20, (inner, inner, 3)), 1, 255
+        )
+        return image
+    if kind == "rgba":
+        alpha = np.broadcast_to(ramp[:, None], (size, size, 1)).astype(np.uint8)
+        return np.concatenate((gradient, alpha), axis=2)
+    raise ValueError("unknown image kind {}".format(kind))
+
+
+def time_call(function, repeat):
+    """ run function repeat times, return the fastest, median and mean duration in seconds """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return {
+        "min": min(durations),
+        "median": float(np.median(durations)),
+        "mean": float(np.mean(durations)),
+    }
+
+
+def bench_color_cube(sizes, resolutions, repeat):
+    for resolution in resolutions:
+        color_cube = ColorCube(resolution=resolution, avoid_color=[0.0, 0.0, 0.0])
+        for size in sizes:
+            for kind in IMAGE_KINDS:
+                image = make_image(kind, size)
+                params = {"resolution": resolution, "size": size, "kind": kind}
+                yield "find_local_maxima", params, time_call(
+                    lambda: color_cube.find_local_maxima(image), repeat
+                )
+                maxima = color_cube.find_local_maxima(image)
+                params = dict(params, maxima=len(maxima))
+                yield "filter_distinct_maxima", params, time_call(
+                    lambda: color_cube.filter_distinct_maxima(maxima), repeat
+                )
+
+
+def bench_crop(sizes, repeat):
+    image_cropper = ImageCrop(32)
+    for size in sizes:
+        image = make_image("bordered", size)
+        yield "crop_image", {"size": size}, time_call(
+            lambda: image_cropper.crop_image(image), repeat
+        )
+
+
+def bench_nearest_color(repeat, count=1000):
+    colors = np.random.default_rng(0).integers(0, 256, (count, 3)).tolist()
+    timing = time_call(
+        lambda: [get_nearest_color([color], color_list) for color in colors], repeat
+    )
+    yield "get_nearest_color", {"colors": count}, timing
+
+
+def bench_main(sizes, image_counts, repeat):
+    for size in sizes:
+        for image_count in image_counts:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                input_dir = Path(temp_dir) / "input"
+                input_dir.mkdir()
+                for i in range(image_count):
+                    kind = IMAGE_KINDS[i % 4]
+                    cv2.imwrite(str(input_dir / "{}.png".format(i)), make_image(kind, size, i))
+                    # bordered images again as jpg, most input images are jpgs
+                    if kind == "bordered":
+                        cv2.imwrite(str(input_dir / "{}.jpg".format(i)), make_image(kind, size, i))
+                args = vars(get_args([str(input_dir), str(Path(temp_dir) / "output")]))
+                yield "main", {"size": size, "images": image_count}, time_call(
+                    lambda: color_main.main(**args), repeat
+                )
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the speedup of each benchmark against the same benchmark in baseline
+        Returns the benchmarks that got slower by more than tolerance
+    """
+    baseline_timings = {
+        (r["stage"], json.dumps(r["params"], sort_keys=True)): r["seconds"]["min"]
+        for r in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        key = (result["stage"], json.dumps(result["params"], sort_keys=True))
+        if key not in baseline_timings:
+            continue
+        before, after = baseline_timings[key], result["seconds"]["min"]
+        print("{:24} {:60} {:9.5f}s -> {:9.5f}s  x{:.2f}".format(
+            key[0], key[1], before, after, before / after if after else float("inf")
+        ))
+        if after > before * (1.0 + tolerance):
+            regressions.append(result)
+    return regressions
+
+
+def main(output, sizes, resolutions, image_counts, repeat, compare_to, tolerance):
+    results = []
+    benchmarks = (
+        bench_color_cube(sizes, resolutions, repeat),
+        bench_crop(sizes, repeat),
+        bench_nearest_color(repeat),
+        bench_main(sizes, image_counts, repeat),
+    )
+    for benchmark in benchmarks:
+        for stage, params, seconds in benchmark:
+            results.append({"stage": stage, "params": params, "seconds": seconds})
+            print(stage, params, "{:.5f}s".format(seconds["min"]), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "machine": platform.machine(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if compare_to:
+        with open(compare_to) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), tolerance)
+        if regressions:
+            print("{} benchmarks regressed".format(len(regressions)), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the color pipeline")
+    parser.add_argument("--output", default=None, help="json file to write results to")
+    parser.add_argument("--sizes", default=[100, 400], type=int, nargs="+")
+    parser.add_argument("--resolutions", default=[20, 40, 64], type=int, nargs="+")
+    parser.add_argument("--image_counts", default=[10, 50], type=int, nargs="+")
+    parser.add_argument("--repeat", default=5, type=int)
+    parser.add_argument(
+        "--compare",
+        dest="compare_to",
+        default=None,
+        help="json results of an earlier run to compare against",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=0.2,
+        type=float,
+        help="relative slowdown that counts as regression when comparing",
+    )
+    sys.exit(main(**vars(parser.parse_args())))
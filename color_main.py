@@ -2,7 +2,7 @@
 Perform color identification on images and save them to their respective color dir
     Arguments:
         input_dir - dir to read images from
-        (NOTE: only takes in one directory, no recursive reading)
+        (NOTE: subdirectories are only read with recursive)
         output_dir - dir to write results to
         save_orig - if save_orig is true then we will also save the original files
         delete - option to delete masked images after you perform analysis on them
@@ -11,76 +11,580 @@ Perform color identification on images and save them to their respective color d
         crop - which method to crop with twoside or fullsize
         min_side_len - min length of each side of image to accept image cropped version
         image_resize - size to resize images for color cube classification
+        workers - number of processes analysing images
+        recursive - also read images from subdirectories of input_dir
+        (NOTE: they keep their path below input_dir in the color dirs, and their
+        originals are looked up at the same path below orig_dir)
+        color_lut_dir - dir to cache the RGB to munsell color lookup table in
+        (NOTE: colors are matched without a lookup table if not given)
+        color_lut_bits - bits per color component of the lookup table
+        color_space - rgb or lab, lab bins colors and matches them to the palette in CIELAB
+        bbox_method - contours or components, components finds the largest object of an image
+        faster on noisy masks (see crop.imagecrop.ImageCrop)
+        bbox_scale - scale of the mask components are found on
+        sample_mode - stride, random or stratified counts a sample of sample_size pixels
+        of the cropped image instead of resizing it to image_resize
+        sample_size - number of pixels sampled per image
+        sample_seed - seed of random and stratified samples, the same for every image
+        decode - full or reduced, reduced decodes large JPEGs at 1/2, 1/4 or 1/8 scale
+        cache - sqlite file to cache results in, images with cached results are not analysed again
+        (NOTE: images that can't be read or decoded are not cached or deleted, they are tried again)
+        cache_size - max number of cached results, least recently used ones are evicted
+        cache_key - stat (path, size and mtime) or content (file hash) to identify images
+        output_mode - copy, hardlink, symlink, reflink or move images into the color dirs
+        (NOTE: links fall back to copies where not possible, e.g. across filesystems)
+        or manifest-only to write labels, colors and hit counts to output_dir/manifest.<format>
+        instead of placing any files
+        manifest_format - csv, jsonl or parquet (needs pyarrow) for manifest-only
+        manifest_top_k - number of colors per image written to the manifest
+        pipeline - sync or async, async reads files, analyses images and writes outputs
+        concurrently (e.g. for network storage)
+        readers - number of files read at a time by the async pipeline
+        writers - number of output files placed at a time
+        stats - print a progress line every stats_interval seconds and per-stage timings at the end
+        stats_json - file to write per-stage timings and throughput to as JSON
+        stats_prometheus - same for the Prometheus textfile format
+        (NOTE: stages are only timed if one of stats, stats_json or stats_prometheus is set)
 """
-from shutil import copy
-from PIL import Image
+import cv2
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from pathlib import Path
 
 from colorcube.colorcube import ColorCube
+from colorcube.lab import LabColorCube
+from colorcube.sampling import sample_pixels
 from config.args import get_args
-from config.constants import color_list, ACCEPTED_IMAGE_EXTENTIONS
+from config.constants import color_list
 from utils.color_functions import *
+from utils.file_functions import decode_image, iter_image_paths, read_image
+from utils.instrumentation import NULL_STATS, PipelineStats, StageTimer
+from utils.manifest import ManifestWriter
+from utils.output_writer import OutputWriter
+from utils.result_cache import ResultCache
 from crop.imagecrop import ImageCrop
 
+# images queued per worker process, bounds memory use of the parallel mode
+PENDING_IMAGES_PER_WORKER = 4
 
-def main(input_dir, output_dir, orig_dir, delete, crop, min_side_length, image_resize):
+# with reduced decoding the shorter side of an image is kept at least this many times
+# larger than image_resize and min_side_length, so cropping still has pixels to work with
+REDUCED_DECODE_MARGIN = 2
+
+# color cube and image cropper of a worker process, created by init_worker
+worker_state = {}
+
+# entries of classify_options that are passed to ImageCrop instead of classify_image
+CROP_OPTIONS = ("bbox_method", "bbox_scale")
+
+
+def make_color_cube(color_space="rgb"):
+    # Create color cube, avoiding resulting colors that are too close to black.
+    # note: this doesnt avoid these colors, just ignores them at the end!!
+    if color_space == "lab":
+        return LabColorCube(avoid_color=[0.0, 0.0, 0.0], channel_order="bgr")
+    return ColorCube(avoid_color=[0.0, 0.0, 0.0], channel_order="bgr")
+
+
+def make_image_cropper(min_side_length, classify_options):
+    """
+    Return the ImageCrop for classify_options and the options left for classify_image
+        crop options are kept in classify_options so cached results depend on them
+    """
+    classify_options = dict(classify_options)
+    crop_options = {
+        name: classify_options.pop(name)
+        for name in CROP_OPTIONS
+        if name in classify_options
+    }
+    return ImageCrop(min_side_length, **crop_options), classify_options
+
+
+def classify_image(
+    image_path,
+    color_cube,
+    image_cropper,
+    crop,
+    image_resize,
+    color_lut=None,
+    decode_min_side=None,
+    stats=NULL_STATS,
+    image_data=None,
+    color_space="rgb",
+    sample_mode=None,
+    sample_size=10000,
+    sample_seed=0,
+):
+    """
+    Return the colors of the image at image_path, the name of the nearest color
+        and the hit counts of the colors in the color cube
+        (None, None, None) if the image was rejected by the cropper or no colors were found
+        None if the image could not be read or decoded, this may be a transient failure
+        (e.g. of a network filesystem), so it is not a result to keep
+        If decode_min_side is set, JPEGs are decoded at reduced scale (see read_image)
+        stats times each stage (see utils.instrumentation)
+        If image_data is given it is decoded instead of reading the file again
+        color_space is the space colors are matched to the palette in, it should match
+        the color cube and color_lut
+        If sample_mode is set (see colorcube.sampling.sample_pixels), sample_size pixels
+        of the cropped image are counted instead of resizing it to image_resize
+    """
+    # Load image and scale down to make the algorithm faster.
+    # Scaling down also gives colors that are more dominant in perception.
+    with stats.stage("decode"):
+        if image_data is None:
+            image = read_image(image_path, decode_min_side)
+        else:
+            image = decode_image(image_data, decode_min_side)
+    if image is None:
+        return None
+
+    # get cropped image
+    if crop:
+        image = image_cropper.crop_image(image, stats)
+    if image is None:
+        return None, None, None
+    if sample_mode:
+        # count a fixed number of pixels without resizing
+        with stats.stage("sample"):
+            image = sample_pixels(image, sample_size, sample_mode, sample_seed)
+    else:
+        # resize image to image_resizeximage_resize, colorcube reads the BGR pixels directly
+        with stats.stage("resize"):
+            image = cv2.resize(image, (image_resize, image_resize))
+    # Get colors for image
+    with stats.stage("histogram"):
+        color_cube.clear_cells()
+        color_cube.accumulate(image)
+    with stats.stage("maxima"):
+        maxima = color_cube.current_local_maxima()
+    with stats.stage("filter"):
+        maxima = color_cube.filter_maxima(maxima)
+    if not maxima:
+        return None, None, None
+    colors = color_cube.maxima_colors(maxima)
+    hit_counts = [m.hit_count for m in maxima]
+    # get name of color for image from color_list
+    with stats.stage("palette"):
+        color_name = get_nearest_color(
+            colors, color_list, color_lut=color_lut, color_space=color_space
+        )
+    return colors, color_name, hit_counts
+
+
+def init_worker(
+    min_side_length, color_lut_dir, color_lut_bits, classify_options, timed=False
+):
+    """
+    create the color cube and image cropper used by this worker process
+        classify_options are the remaining keyword arguments of classify_image
+        if timed, stage timings are returned with every result
+    """
+    image_cropper, classify_options = make_image_cropper(
+        min_side_length, classify_options
+    )
+    worker_state.update(classify_options)
+    worker_state["stats"] = StageTimer() if timed else NULL_STATS
+    color_space = classify_options.get("color_space", "rgb")
+    worker_state["color_cube"] = make_color_cube(color_space)
+    worker_state["image_cropper"] = image_cropper
+    # the table is memory-mapped, so all workers share the same pages
+    worker_state["color_lut"] = (
+        load_color_lut(color_lut_dir, color_list, color_lut_bits, color_space)
+        if color_lut_dir
+        else None
+    )
+
+
+def classify_image_in_worker(image_path, image_data=None):
+    result = classify_image(image_path, image_data=image_data, **worker_state)
+    return image_path, result, worker_state["stats"].pop_timings()
+
+
+async def read_and_classify(image_path, read_pool, analysis_pool, timed):
+    """
+    Read the file at image_path in read_pool, then decode and analyse it in analysis_pool
+        returns what classify_image_in_worker returns, with the read timing added if timed
+        If the file can't be read, it is not analysed and the result is None, so a
+        transient failure (e.g. of a network filesystem) is not taken for an image
+        without colors
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        image_data = await loop.run_in_executor(read_pool, image_path.read_bytes)
+    except OSError as e:
+        print(e)
+        read_seconds = time.perf_counter() - start
+        return image_path, None, [("read", read_seconds)] if timed else []
+    read_seconds = time.perf_counter() - start
+    image_path, result, timings = await loop.run_in_executor(
+        analysis_pool, classify_image_in_worker, image_path, image_data
+    )
+    if timed:
+        timings = [("read", read_seconds)] + list(timings)
+    return image_path, result, timings
+
+
+def classify_images_serial(
+    images, min_side_length, color_lut, classify_options, cache=None, stats=NULL_STATS
+):
+    """
+    Classify images one after another, yielding (image_path, (colors, color_name, hit_counts))
+        or (image_path, None) if the image could not be read (see classify_image)
+        Images with a result in cache are not analysed again, None results are not cached
+    """
+    image_cropper, classify_options = make_image_cropper(
+        min_side_length, classify_options
+    )
+    color_cube = make_color_cube(classify_options.get("color_space", "rgb"))
+    for image_path in images:
+        result = None
+        if cache is not None:
+            with stats.stage("cache"):
+                key = cache.key(image_path)
+                result = cache.get(key)
+        if result is None:
+            result = classify_image(
+                image_path,
+                color_cube,
+                image_cropper,
+                color_lut=color_lut,
+                stats=stats,
+                **classify_options
+            )
+            if cache is not None and result is not None:
+                cache.put(key, *result)
+        yield image_path, result
+
+
+def classify_images_parallel(
+    images,
+    workers,
+    min_side_length,
+    color_lut_dir,
+    color_lut_bits,
+    classify_options,
+    cache=None,
+    stats=NULL_STATS,
+):
+    """
+    Classify images in a pool of worker processes, yielding
+        (image_path, (colors, color_name, hit_counts)) as results come in,
+        or (image_path, None) if the image could not be read
+        At most PENDING_IMAGES_PER_WORKER images per worker are queued at a time
+        so memory stays flat for any number of images
+        Images with a result in cache are not sent to the workers
+        Workers send their stage timings back with each result, they are added to stats
+    """
+    with ProcessPoolExecutor(
+        workers,
+        initializer=init_worker,
+        initargs=(
+            min_side_length,
+            color_lut_dir,
+            color_lut_bits,
+            classify_options,
+            stats.enabled,
+        ),
+    ) as pool:
+        yield from classify_submitted(
+            images,
+            lambda image_path: pool.submit(classify_image_in_worker, image_path),
+            workers * PENDING_IMAGES_PER_WORKER,
+            cache,
+            stats,
+        )
+
+
+def classify_images_async(
+    images,
+    workers,
+    readers,
+    min_side_length,
+    color_lut_dir,
+    color_lut_bits,
+    classify_options,
+    cache=None,
+    stats=NULL_STATS,
+):
+    """
+    Classify images in an asyncio pipeline, yielding (image_path, (colors, color_name, hit_counts))
+        as results come in, or (image_path, None) if the image could not be read.
+        Up to readers files are read at a time while up to workers images are decoded
+        and analysed (in a thread for one worker, else in processes), and the caller
+        writes outputs of finished images meanwhile, so no stage waits for the I/O
+        of another. At most readers + workers * PENDING_IMAGES_PER_WORKER
+        images are in the pipeline at a time, which bounds the queues between stages
+        Images with a result in cache are not read
+    """
+    # asyncio takes long to import and only this mode needs it
+    import asyncio
+
+    # with one worker the analysis runs in a thread, worker_state is only used by it
+    analysis_pool = (ProcessPoolExecutor if workers > 1 else ThreadPoolExecutor)(
+        workers,
+        initializer=init_worker,
+        initargs=(
+            min_side_length,
+            color_lut_dir,
+            color_lut_bits,
+            classify_options,
+            stats.enabled,
+        ),
+    )
+    # the event loop runs in its own thread, so results can be consumed from this one
+    loop = asyncio.new_event_loop()
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    try:
+        with ThreadPoolExecutor(readers) as read_pool, analysis_pool:
+            yield from classify_submitted(
+                images,
+                lambda image_path: asyncio.run_coroutine_threadsafe(
+                    read_and_classify(
+                        image_path, read_pool, analysis_pool, stats.enabled
+                    ),
+                    loop,
+                ),
+                readers + workers * PENDING_IMAGES_PER_WORKER,
+                cache,
+                stats,
+            )
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+        loop.close()
+
+
+def classify_submitted(images, submit, max_pending, cache=None, stats=NULL_STATS):
+    """
+    Yield (image_path, result) of images as the futures returned by submit(image_path) finish
+        Futures have to return (image_path, result, timings) like classify_image_in_worker
+        or read_and_classify
+        At most max_pending images are submitted at a time so memory stays flat
+        Images with a result in cache are not submitted, new results are cached
+        except None results of images that could not be read
+    """
+    keys = {}
+
+    def finished(futures):
+        for future in futures:
+            image_path, result, timings = future.result()
+            stats.record_all(timings)
+            key = keys.pop(image_path, None)
+            if key is not None and result is not None:
+                cache.put(key, *result)
+            yield image_path, result
+
+    pending = set()
+    for image_path in images:
+        if cache is not None:
+            with stats.stage("cache"):
+                key = cache.key(image_path)
+                result = cache.get(key)
+            if result is not None:
+                yield image_path, result
+                continue
+            keys[image_path] = key
+        pending.add(submit(image_path))
+        if len(pending) >= max_pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finished(done)
+    yield from finished(wait(pending).done)
+
+
+def main(
+    input_dir,
+    output_dir,
+    orig_dir,
+    delete,
+    crop,
+    min_side_length,
+    image_resize,
+    workers=1,
+    recursive=False,
+    color_lut_dir=None,
+    color_lut_bits=8,
+    color_space="rgb",
+    bbox_method="contours",
+    bbox_scale=1.0,
+    sample_mode=None,
+    sample_size=10000,
+    sample_seed=0,
+    decode="full",
+    cache=None,
+    cache_size=1000000,
+    cache_key="stat",
+    output_mode="copy",
+    manifest_format="csv",
+    manifest_top_k=5,
+    pipeline="sync",
+    readers=8,
+    writers=1,
+    stats=False,
+    stats_interval=10.0,
+    stats_json=None,
+    stats_prometheus=None,
+):
 
     # create the color subdirs
-    input_dir = Path(args.input_dir)
-    output_dir = Path(args.output_dir)
-    original_images_dir = Path(args.orig_dir)
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
+    original_images_dir = Path(orig_dir) if orig_dir else None
     clothing_position = input_dir.name
 
+    if delete and output_mode == "symlink":
+        raise ValueError(
+            "symlinked images need their source, use another output_mode with delete"
+        )
+
     # create the output dir heirarchy if needed
     cropped_images_output = output_dir / "cropped" / clothing_position
     original_images_output = output_dir / "orig_images" / clothing_position
-    make_color_dir_heirarchy(cropped_images_output, color_list)
-    if str(original_images_dir):
-        make_color_dir_heirarchy(original_images_output, color_list)
+    if output_mode != "manifest-only":
+        make_color_dir_heirarchy(cropped_images_output, color_list)
+        if original_images_dir is not None:
+            make_color_dir_heirarchy(original_images_output, color_list)
 
-    # Create color cube, avoiding resulting colors that are too close to black.
-    # note: this doesnt avoid these colors, just ignores them at the end!!
-    color_cube = ColorCube(avoid_color=[0.0, 0.0, 0.0])
+    # read images of accepted exts from input_dir as they are found
+    images = iter_image_paths(input_dir, recursive=recursive)
 
-    # read images of accepted exts from input_dir
-    images = [
-        image_path
-        for ext in ACCEPTED_IMAGE_EXTENTIONS
-        for image_path in Path(input_dir).glob(ext)
-    ]
+    # build the color lookup table once before any worker needs it
+    color_lut = None
+    if color_lut_dir:
+        color_lut = load_color_lut(
+            color_lut_dir, color_list, color_lut_bits, color_space
+        )
 
-    for image_path in images:
-        # Load image and scale down to make the algorithm faster.
-        # Scaling down also gives colors that are more dominant in perception.
-        image_name = image_path.name
-        image = cv2.imread(str(image_path))
-
-        # get cropped image
-        if crop:
-            image = image_cropper.crop_image(image)
-        if image is not None:
-            # resize image to image_resizeximage_resize and change to PIL for colorcube
-            image = cv2.resize(image, (image_resize, image_resize))
-            image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-            # Get colors for image
-            colors = color_cube.get_colors(image)
-            if colors:
-                # get name of color for image from color_list
-                color_name = get_nearest_color(colors, my_list)
-                # save image to output dirs
-                cropped_output_path = cropped_images_output / color_name
-                original_output_path = original_images_output / color_name
-                # try to save image
-                # copy is faster than cv2.imwrite
-                try:
-                    copy(image_path, cropped_output_path)
-                    if original_images_dir is not None:
-                        copy(original_images_dir / image_name, original_output_path)
-                except Exception as e:
-                    print(e)
-        # delete source if arg set
-        if args.delete:
-            image_path.unlink()
+    classify_options = {"crop": crop, "image_resize": image_resize}
+    if color_space != "rgb":
+        # only set when needed so results cached in rgb stay valid
+        classify_options["color_space"] = color_space
+    if bbox_method != "contours":
+        classify_options.update(bbox_method=bbox_method, bbox_scale=bbox_scale)
+    if sample_mode:
+        classify_options.update(
+            sample_mode=sample_mode, sample_size=sample_size, sample_seed=sample_seed
+        )
+    if decode == "reduced":
+        classify_options["decode_min_side"] = REDUCED_DECODE_MARGIN * max(
+            image_resize, min_side_length
+        )
+
+    pipeline_stats = NULL_STATS
+    if stats or stats_json or stats_prometheus:
+        pipeline_stats = PipelineStats(stats_interval if stats else None)
+
+    result_cache = None
+    if cache:
+        # cached results are dropped as soon as any of these change
+        color_cube = make_color_cube(color_space)
+        settings = {
+            "resolution": color_cube.resolution,
+            "distinct_threshold": color_cube.distinct_threshold,
+            "bright_threshold": color_cube.bright_threshold,
+            "avoid_color": color_cube.avoid_color,
+            "min_side_length": min_side_length,
+            "color_lut_bits": color_lut_bits if color_lut_dir else None,
+            "palette": palette_hash(color_list),
+        }
+        settings.update(classify_options)
+        result_cache = ResultCache(cache, settings, cache_size, cache_key)
+
+    if pipeline == "async":
+        # reads, analysis and the writes below overlap
+        results = classify_images_async(
+            images,
+            workers,
+            readers,
+            min_side_length,
+            color_lut_dir,
+            color_lut_bits,
+            classify_options,
+            result_cache,
+            pipeline_stats,
+        )
+    elif workers > 1:
+        # analysis runs in the worker processes, files are copied here
+        results = classify_images_parallel(
+            images,
+            workers,
+            min_side_length,
+            color_lut_dir,
+            color_lut_bits,
+            classify_options,
+            result_cache,
+            pipeline_stats,
+        )
+    else:
+        results = classify_images_serial(
+            images,
+            min_side_length,
+            color_lut,
+            classify_options,
+            result_cache,
+            pipeline_stats,
+        )
+
+    manifest = None
+    if output_mode == "manifest-only":
+        manifest = ManifestWriter(
+            output_dir / "manifest.{}".format(manifest_format),
+            manifest_format,
+            manifest_top_k,
+        )
+    output_writer = OutputWriter(output_mode, writers=writers, stats=pipeline_stats)
+    for image_path, result in results:
+        if result is None:
+            # the image could not be read, it is left where it is for the next run
+            pipeline_stats.image_done(0)
+            continue
+        colors, color_name, hit_counts = result
+        # file sizes are only looked up when stats are collected
+        bytes_read = image_path.stat().st_size if pipeline_stats.enabled else 0
+        if color_name and manifest is not None:
+            manifest.write(image_path, color_name, colors, hit_counts)
+        elif color_name:
+            # queue image for the output dirs, files are placed in batches
+            # (copying is faster than cv2.imwrite, linking faster still).
+            # Images of subdirs keep their path below input_dir, so files
+            # with the same name in different subdirs don't replace each other
+            relative_path = image_path.relative_to(input_dir)
+            output_writer.add(
+                image_path, cropped_images_output / color_name, relative_path
+            )
+            if original_images_dir is not None:
+                output_writer.add(
+                    original_images_dir / relative_path,
+                    original_images_output / color_name,
+                    relative_path,
+                )
+        # delete source if arg set, moved images are gone already
+        if delete and not (color_name and output_mode == "move"):
+            output_writer.remove(image_path)
+        pipeline_stats.image_done(bytes_read)
+    output_writer.close()
+    if manifest is not None:
+        manifest.close()
+
+    if result_cache is not None:
+        result_cache.close()
+
+    if stats:
+        pipeline_stats.print_summary()
+    if stats_json:
+        pipeline_stats.write_json(stats_json)
+    if stats_prometheus:
+        pipeline_stats.write_prometheus(stats_prometheus)
 
 
 if __name__ == "__main__":
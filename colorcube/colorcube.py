@@ -20,12 +20,43 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import gc
 import math
 import numpy
 
+# Cubes of at least this resolution use the sparse mode unless told otherwise
+SPARSE_MIN_RESOLUTION = 64
+
+
+def neighbour_max(counts, out=None, work=None):
+    # Returns the maximum over the 3x3x3 neighbourhood (the cell itself included)
+    # of every cell in the last three dimensions of counts. The maximum filter is
+    # separable, so it is applied to one color dimension after the other.
+    # out receives the result and work holds the passes in between, both shaped like counts.
+    # Passing them in saves allocating (and page faulting) two grids per call.
+    if out is None:
+        out = numpy.empty_like(counts)
+    if work is None:
+        work = numpy.empty_like(counts)
+    source = counts
+    for axis, target in zip(range(counts.ndim - 3, counts.ndim), (out, work, out)):
+        cells = numpy.moveaxis(source, axis, 0)
+        result = numpy.moveaxis(target, axis, 0)
+        # Maximum of each cell and the one before it, then of that and the one after it
+        result[0] = cells[0]
+        numpy.maximum(cells[1:], cells[:-1], out=result[1:])
+        numpy.maximum(result[:-1], cells[1:], out=result[:-1])
+        source = target
+    return out
+
+
 class LocalMaximum:
     # Local maxima as found during the image analysis.
     # We need this class for ordering by cell hit count.
+    # Noisy images have thousands of maxima, slots make each one cheaper to build.
+    __slots__ = ("hit_count", "cell_index", "r", "g", "b")
+
     def __init__(self, hit_count, cell_index, r, g, b):
         # Hit count of the cell
         self.hit_count = hit_count
@@ -35,16 +66,15 @@ class LocalMaximum:
         self.r = r
         self.g = g
         self.b = b
-        
-class CubeCell:
-    # The color cube is made out of these cells
-    def __init__(self):
-        # Count of hits (dividing the accumulators by this value gives the average color)
-        self.hit_count = 0
-        # Accumulators for color components
-        self.r_acc = 0.0
-        self.g_acc = 0.0
-        self.b_acc = 0.0
+
+
+# Snapshot of a single cell of the color cube, see ColorCube.cells.
+# Snapshots are read only, assigning to a field raises AttributeError. The cube keeps its
+# cells in the arrays hit_count, r_acc, g_acc and b_acc, changes go there.
+# hit_count is the count of hits (dividing the accumulators by it gives the average color),
+# r_acc, g_acc and b_acc are the accumulators for the color components.
+CubeCell = collections.namedtuple("CubeCell", ["hit_count", "r_acc", "g_acc", "b_acc"], defaults=(0, 0.0, 0.0, 0.0))
+
 
 class ColorCube:
     # Uses a 3d RGB histogram to find local maximas in the density distribution
@@ -53,7 +83,12 @@ class ColorCube:
     # threhold value normally at .2
     # might want to change resolution, gives amount of colors
     # brighness threshold will accept values of color greater than 3 (rgb)
-    def __init__(self, resolution=40, avoid_color=None, distinct_threshold=0.1, bright_threshold=0.012):
+    # sparse mode only visits cells that were hit, it is used for high resolutions (see SPARSE_MIN_RESOLUTION)
+    # unless sparse is given
+    # channel order of array images, "bgr" takes OpenCV images as they are (PIL images are always rgb)
+    # max_colors stops the distinct color filter early, for callers that need only the top few colors
+    def __init__(self, resolution=40, avoid_color=None, distinct_threshold=0.1, bright_threshold=0.012,
+                 sparse=None, channel_order="rgb", max_colors=None):
 
         # Keep resolution
         self.resolution = resolution
@@ -69,11 +104,47 @@ class ColorCube:
         # Colors that are darker than this go away
         self.bright_threshold = bright_threshold
 
+        # Most colors returned per image (all distinct ones if None), the strongest ones are kept
+        self.max_colors = max_colors
+
         # Helper variable to have cell count handy
         self.cell_count = resolution * resolution * resolution
 
-        # Create cells
-        self.cells = [CubeCell() for k in range(self.cell_count)]
+        # Only track, clear and search cells that were hit instead of the whole grid
+        if sparse is None:
+            sparse = resolution >= SPARSE_MIN_RESOLUTION
+        self.sparse = sparse
+
+        # Sorted linear indices of the cells hit since the last clear. Sparse cubes always
+        # track them, dense cubes set them to None once an accumulation counted into the whole grid.
+        self.touched = numpy.zeros(0, dtype=numpy.intp)
+
+        # Positions of the red, green and blue components in the pixels of array images
+        if channel_order not in ("rgb", "bgr"):
+            raise ValueError("channel_order must be 'rgb' or 'bgr', got %r" % (channel_order,))
+        self.channel_order = channel_order
+        self.channels = (0, 1, 2) if channel_order == "rgb" else (2, 1, 0)
+
+        # Color component value in [0, 1] and cell index in each color dimension
+        # for every 8 bit component value, used by the histogram
+        self.component_values = numpy.arange(256) / 255.0
+        self.component_cells = (self.component_values * (float(resolution) - 1.0)).astype(numpy.intp)
+        self.dark_limit = int(numpy.count_nonzero(self.component_values < bright_threshold))
+
+        # Offset of every 8 bit component value in the linear cell index, per color dimension,
+        # so the index of a pixel is the sum of three lookups
+        self.component_offsets = tuple(
+            self.component_cells * step for step in (1, resolution, resolution * resolution))
+
+        # Cell storage, one contiguous array for the hit counts and one for each
+        # color accumulator, indexed by linear cell index. Allocated once and
+        # reset in place, so a cube can be reused for any number of images.
+        # 32 bit hit counts hold images of up to 2**31 pixels and halve the memory
+        # the maxima search reads.
+        self.hit_count = numpy.zeros(self.cell_count, dtype=numpy.int32)
+        self.r_acc = numpy.zeros(self.cell_count, dtype=numpy.float64)
+        self.g_acc = numpy.zeros(self.cell_count, dtype=numpy.float64)
+        self.b_acc = numpy.zeros(self.cell_count, dtype=numpy.float64)
 
         # Indices for neighbour cells in three dimensional grid
         self.neighbour_indices = [
@@ -114,25 +185,98 @@ class ColorCube:
             [-1, -1, -1]
         ]
 
+        # Neighbour offsets as array, used by the sparse maxima search
+        self.neighbour_offsets = numpy.array(self.neighbour_indices, dtype=numpy.intp)
+
+        # Grids the dense maxima search filters the hit counts into, allocated on first use
+        self.neighbour_counts = None
+        self.neighbour_work = None
+
+        # Per cell flag and position among the hit cells, used by dense cubes to count small
+        # images per hit cell (see accumulate). Allocated on first use, the flags are left cleared.
+        self.cell_hit = None
+        self.cell_position = None
+
+        # Hit counts of the cells whose neighbours are looked up are copied into a grid with
+        # an empty border cell on every side (allocated on first use and emptied after each
+        # lookup), so the 27 neighbours of any cell are at fixed offsets from its index
+        self.padded_resolution = resolution + 2
+        self.padded_offsets = self.neighbour_offsets.dot(
+            [1, self.padded_resolution, self.padded_resolution * self.padded_resolution])
+        self.padded_counts = None
+
     def cell_index(self, r, g, b):
         # Returns linear index for cell with given 3d index
         return (r+g*self.resolution+b*self.resolution*self.resolution)
 
+    def padded_index(self, indices):
+        # Returns the index in the padded grid of the given linear cell indices
+        r = indices % self.resolution + 1
+        g = indices // self.resolution % self.resolution + 1
+        b = indices // (self.resolution * self.resolution) + 1
+        return r + (g + b * self.padded_resolution) * self.padded_resolution
+
+    def cube_params(self):
+        # Returns the keyword arguments that build a cube mapping pixels to the same cells,
+        # used to rebuild the cube in worker processes (see colorcube.tiling)
+        return {
+            "resolution": self.resolution,
+            "bright_threshold": self.bright_threshold,
+            "channel_order": self.channel_order,
+        }
+
+    @property
+    def cells(self):
+        # Cells as a list of read only CubeCell snapshots, for callers that inspect single cells.
+        # Writing to a snapshot raises instead of being lost, cells are changed through the arrays
+        # (e.g. cube.hit_count[i] += 1). Builds cell_count objects, prefer the arrays for anything
+        # performance related.
+        return list(map(CubeCell, self.hit_count.tolist(), self.r_acc.tolist(), self.g_acc.tolist(),
+                        self.b_acc.tolist()))
+
     def clear_cells(self):
-        for c in self.cells:
-            c.hit_count = 0
-            c.r_acc = 0.0
-            c.g_acc = 0.0
-            c.b_acc = 0.0
+        if self.touched is not None:
+            # Only the touched cells can be non zero
+            self.hit_count[self.touched] = 0
+            self.r_acc[self.touched] = 0.0
+            self.g_acc[self.touched] = 0.0
+            self.b_acc[self.touched] = 0.0
+        else:
+            self.hit_count.fill(0)
+            self.r_acc.fill(0.0)
+            self.g_acc.fill(0.0)
+            self.b_acc.fill(0.0)
+        self.touched = numpy.zeros(0, dtype=numpy.intp)
 
     def get_colors(self, image):
-        m = self.find_local_maxima(image)
-
+        return self.colors_from_maxima(self.find_local_maxima(image))
+
+    def get_colors_batch(self, images):
+        # Returns the colors of each image, like get_colors for every image on its own.
+        # images is a N x H x W x C uint8 array or a list of H x W x C arrays (sizes may differ).
+        # This is a loop over the images reusing this cube: counting all histograms in one
+        # vectorized pass was measured slower than the loop, most of the time per image goes
+        # into its maxima and the distinct color filter, which a batch can't share.
+        return [self.get_colors(image) for image in images]
+
+    def get_maxima(self, image):
+        # Returns the local maxima get_colors converts to colors, with their hit counts
+        return self.filter_maxima(self.find_local_maxima(image))
+
+    def filter_maxima(self, m):
+        # Drops local maxima too close to the avoid color or to a stronger maximum
         if not self.avoid_color is None:
             m = self.filter_too_similar(m)
 
-        m = self.filter_distinct_maxima(m)
+        return self.filter_distinct_maxima(m)
+
+    def colors_from_maxima(self, m):
+        # Filters local maxima and converts the remaining ones to 8 bit RGB colors
+        return self.maxima_colors(self.filter_maxima(m))
 
+    @staticmethod
+    def maxima_colors(m):
+        # Converts local maxima to 8 bit RGB colors
         colors = []
         for n in m:
             r = int(n.r*255.0)
@@ -142,134 +286,252 @@ class ColorCube:
 
         return colors
 
-    def find_local_maxima(self, image):
-        # Finds and returns local maxima in 3d histogram, sorted with respect to hit count
-
-        # Reset all cells
-        self.clear_cells()
-
-        # Iterate over all pixels of the image
-        for p in image.getdata():
-
-            # Get color components
-            r = float(p[0])/255.0
-            g = float(p[1])/255.0
-            b = float(p[2])/255.0
-            
-            #if r == g and g == b:
-            #    continue
-            if r < self.bright_threshold and g < self.bright_threshold and b < self.bright_threshold:
-                continue
-
+    def pixel_cells(self, image):
+        # Maps all pixels of the image to cells. Accepts a PIL image or a HxWx3/4 uint8 array
+        # with components in channel_order (an alpha channel always comes last).
+        # Returns the linear cell index and the color components in [0, 1]
+        # of every pixel that is not dropped by the brightness threshold.
+        channels = self.channels if isinstance(image, numpy.ndarray) else (0, 1, 2)
+        pixels = numpy.asarray(image)
+        if pixels.ndim < 2 or pixels.shape[-1] not in (3, 4):
+            raise ValueError("Expected an image with 3 or 4 channels, got shape %s" % (pixels.shape,))
+        pixels = pixels.reshape(-1, pixels.shape[-1])
+
+        # Split into color components, one contiguous array each
+        r, g, b = (numpy.ascontiguousarray(pixels[:, k]) for k in channels)
+
+        # Colors that are darker than the threshold in every component go away.
+        # Component values are compared in 8 bit, dark_limit is the first value
+        # that is not darker than the threshold once scaled to [0, 1].
+        keep = (r >= self.dark_limit) | (g >= self.dark_limit) | (b >= self.dark_limit)
+        if not keep.all():
+            r, g, b = r[keep], g[keep], b[keep]
+
+        if pixels.shape[1] == 4:
             # If image has alpha channel, weight colors by it
-            if len(p) == 4:
-                a = float(p[3])/255.0
-                r *= a
-                g *= a
-                b *= a
+            a = self.component_values.take(pixels[keep, 3])
+            r = self.component_values.take(r) * a
+            g = self.component_values.take(g) * a
+            b = self.component_values.take(b) * a
 
             # Map color components to cell indices in each color dimension
-            r_index = int(r*(float(self.resolution)-1.0))
-            g_index = int(g*(float(self.resolution)-1.0))
-            b_index = int(b*(float(self.resolution)-1.0))
-
-            # Compute linear cell index
-            index = self.cell_index(r_index, g_index, b_index)
+            r_index = (r * (float(self.resolution) - 1.0)).astype(numpy.intp)
+            g_index = (g * (float(self.resolution) - 1.0)).astype(numpy.intp)
+            b_index = (b * (float(self.resolution) - 1.0)).astype(numpy.intp)
+        else:
+            # Without alpha, the offsets of all 256 component values are known up front
+            r_offsets, g_offsets, b_offsets = self.component_offsets
+            index = r_offsets.take(r)
+            index += g_offsets.take(g)
+            index += b_offsets.take(b)
+            r = self.component_values.take(r)
+            g = self.component_values.take(g)
+            b = self.component_values.take(b)
+            return index, r, g, b
+
+        # Compute linear cell indices
+        return self.cell_index(r_index, g_index, b_index), r, g, b
+
+    def accumulate(self, image):
+        # Adds all pixels of the image to the hit counts and color accumulators at once.
+        # Accepts a PIL image or a HxWx3/4 uint8 array.
+        index, r, g, b = self.pixel_cells(image)
+
+        if self.sparse:
+            # Count hits and sum up pixel colors per distinct cell only
+            cells, index = numpy.unique(index, return_inverse=True)
+            index = index.reshape(-1)
+        elif len(index) < self.cell_count:
+            # An image with fewer pixels than cells hits fewer distinct cells, counting into
+            # the grid would allocate (and page fault) counts for all cells up to the highest
+            # one hit on every call. The hit cells are found by flagging them in the grid
+            # instead of sorting the pixels, and each pixel is mapped to its cell's position.
+            if self.cell_hit is None:
+                self.cell_hit = numpy.zeros(self.cell_count, dtype=bool)
+                self.cell_position = numpy.zeros(self.cell_count, dtype=numpy.intp)
+            self.cell_hit[index] = True
+            cells = numpy.flatnonzero(self.cell_hit)
+            self.cell_hit[cells] = False
+            self.cell_position[cells] = numpy.arange(len(cells))
+            index = self.cell_position.take(index)
+        else:
+            # Count hits and sum up pixel colors per cell. The counts only reach up to
+            # the highest cell that was hit, they are added to the leading cells.
+            # Only one count is alive at a time, each one goes before the next is made.
+            # The hit cells are no longer tracked, clear_cells empties the whole grid.
+            self.touched = None
+            hits = numpy.bincount(index)
+            cells = slice(0, len(hits))
+            self.hit_count[cells] += hits
+            del hits
+            self.r_acc[cells] += numpy.bincount(index, weights=r)
+            self.g_acc[cells] += numpy.bincount(index, weights=g)
+            self.b_acc[cells] += numpy.bincount(index, weights=b)
+            return
+
+        self.add_sums((
+            cells,
+            numpy.bincount(index),
+            numpy.bincount(index, weights=r),
+            numpy.bincount(index, weights=g),
+            numpy.bincount(index, weights=b),
+        ))
+
+    def add_sums(self, sums):
+        # Adds hit counts and color sums of cells, given as (sorted distinct cells, hit counts,
+        # r, g and b sums) with one entry per cell, e.g. the merged tiles of colorcube.tiling
+        cells, hits, r, g, b = sums
+        self.hit_count[cells] += hits
+        self.r_acc[cells] += r
+        self.g_acc[cells] += g
+        self.b_acc[cells] += b
+        if self.touched is not None:
+            self.touched = numpy.union1d(self.touched, cells) if len(self.touched) else cells
 
-            # Increase hit count of cell
-            self.cells[index].hit_count += 1
-
-            # Add pixel colors to cell color accumulators
-            self.cells[index].r_acc += r
-            self.cells[index].g_acc += g
-            self.cells[index].b_acc += b
-
-        # We collect local maxima in here
-        local_maxima = []
-
-        # Find local maxima in the grid
-        for r in range(self.resolution):
-            for g in range(self.resolution):
-                for b in range(self.resolution):
-
-                    local_index = self.cell_index(r, g, b)
-
-                    # Get hit count of this cell
-                    local_hit_count = self.cells[local_index].hit_count
-
-                    # If this cell has no hits, ignore it (we are not interested in zero hit cells)
-                    if local_hit_count == 0:
-                        continue
-
-                    # It is a local maximum until we find a neighbour with a higher hit count
-                    is_local_maximum = True
-
-                    # Check if any neighbour has a higher hit count, if so, no local maxima
-
-                    for n in range(27):
-                        r_index = r+self.neighbour_indices[n][0]
-                        g_index = g+self.neighbour_indices[n][1]
-                        b_index = b+self.neighbour_indices[n][2]
-
-                        # Only check valid cell indices (skip out of bounds indices)
-
-                        if r_index >= 0 and g_index >= 0 and b_index >= 0:
-                            if r_index < self.resolution and g_index < self.resolution and b_index < self.resolution:
-                                if self.cells[self.cell_index(r_index, g_index, b_index)].hit_count > local_hit_count:
-                                    # Neighbour hit count is higher, so this is NOT a local maximum.
-                                    is_local_maximum = False
-                                    # Break inner loop
-                                    break
-
-                    # If this is not a local maximum, continue with loop.
-                    if is_local_maximum == False:
-                        continue
-
-                    # Otherwise add this cell as local maximum
-                    avg_r = self.cells[local_index].r_acc / \
-                        float(self.cells[local_index].hit_count)
-                    avg_g = self.cells[local_index].g_acc / \
-                        float(self.cells[local_index].hit_count)
-                    avg_b = self.cells[local_index].b_acc / \
-                        float(self.cells[local_index].hit_count)
-                    local_maxima.append(LocalMaximum(
-                        local_hit_count, local_index, avg_r, avg_g, avg_b))
+    def find_local_maxima(self, image):
+        # Finds and returns local maxima in 3d histogram, sorted with respect to hit count
 
-        # Return local maxima sorted with respect to hit count
-        return sorted(local_maxima, key=lambda x: x.hit_count, reverse=True)
+        # Reset all cells
+        self.clear_cells()
 
-    def filter_distinct_maxima(self, maxima):
+        # Accumulate all pixels of the image in one pass
+        self.accumulate(image)
+
+        return self.current_local_maxima()
+
+    def current_local_maxima(self):
+        # Finds and returns local maxima of the cells accumulated so far, sorted with respect to hit count
+        if self.sparse:
+            return self.local_maxima(self.sparse_maxima())
+
+        # With few cells hit, looking up their neighbours is cheaper than filtering the grid
+        hit_cells = self.touched if self.touched is not None else numpy.flatnonzero(self.hit_count)
+        if len(hit_cells) * len(self.neighbour_indices) < self.cell_count:
+            return self.local_maxima(self.neighbourhood_maxima(hit_cells))
+
+        # View hit counts as 3d grid, indexed by [b, g, r]
+        counts = self.hit_count.reshape(self.resolution, self.resolution, self.resolution)
+        if self.neighbour_counts is None or self.neighbour_counts.dtype != counts.dtype:
+            self.neighbour_counts = numpy.empty_like(counts)
+            self.neighbour_work = numpy.empty_like(counts)
+
+        # A cell with hits is a local maximum unless a neighbour has a higher hit count
+        is_local_maximum = counts >= neighbour_max(counts, self.neighbour_counts, self.neighbour_work)
+        is_local_maximum &= counts > 0
+
+        return self.local_maxima(numpy.flatnonzero(is_local_maximum))
+
+    def sparse_maxima(self):
+        # Returns the linear indices of the touched cells that are local maxima
+        return self.neighbourhood_maxima(self.touched)
+
+    def neighbourhood_maxima(self, indices):
+        # Returns the given linear cell indices (all cells with hits) that are local maxima,
+        # looking up the 27 neighbours of each of these cells only.
+        # Out of bounds neighbours are border cells of the padded grid, which stay empty.
+        if self.padded_counts is None:
+            self.padded_counts = numpy.zeros(self.padded_resolution ** 3, dtype=self.hit_count.dtype)
+        padded = self.padded_index(indices)
+        hit_count = self.hit_count[indices]
+        self.padded_counts[padded] = hit_count
+        if len(indices) * len(self.padded_offsets) <= 16384:
+            # All neighbours at once while the block of their indices stays below 128 KB
+            neighbour_count = self.padded_counts.take(padded[:, None] + self.padded_offsets).max(axis=1)
+        else:
+            # One neighbour after the other, larger blocks would be allocated (and page faulted)
+            # afresh on every call
+            neighbour_count = self.padded_counts.take(padded)
+            for offset in self.padded_offsets.tolist():
+                numpy.maximum(neighbour_count, self.padded_counts.take(padded + offset), out=neighbour_count)
+
+        # Leave the grid empty for the next lookup
+        self.padded_counts[padded] = 0
+        return indices[hit_count >= neighbour_count]
+
+    def local_maxima(self, indices):
+        # Returns LocalMaximum entries for the given linear cell indices,
+        # sorted with respect to hit count. Cells with equal hit counts keep
+        # the order of a scan over r, then g, then b.
+        hit_count = self.hit_count[indices]
+        r_index = indices % self.resolution
+        g_index = indices // self.resolution % self.resolution
+        b_index = indices // (self.resolution * self.resolution)
+        order = numpy.lexsort((self.cell_index(b_index, g_index, r_index), -hit_count))
+        indices = indices[order]
+        hit_count = hit_count[order]
+
+        # Average color of each cell
+        avg_r = self.r_acc[indices] / hit_count
+        avg_g = self.g_acc[indices] / hit_count
+        avg_b = self.b_acc[indices] / hit_count
+
+        # None of the new entries can be garbage, collections triggered by building
+        # thousands of them (noisy images) would only walk the ones built so far
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return list(map(LocalMaximum, hit_count.tolist(), indices.tolist(),
+                            avg_r.tolist(), avg_g.tolist(), avg_b.tolist()))
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def filter_distinct_maxima(self, maxima, max_colors=None):
         # Returns a filtered version of the specified array of maxima,
-        # in which all entries have a minimum distance of self.distinct_threshold
+        # in which all entries have a minimum distance of self.distinct_threshold.
+        # Maxima are accepted greedily in the given order (by hit count), so each
+        # one is only compared to the accepted maxima nearby: accepted colors are
+        # kept in a grid of cells as wide as the threshold, a color closer than the
+        # threshold can only be in the same or a neighbouring grid cell.
+        # Stops after max_colors accepted maxima (self.max_colors by default).
+        if max_colors is None:
+            max_colors = self.max_colors
+
+        threshold = self.distinct_threshold
+        if threshold <= 0:
+            # No distance is below the threshold, every maximum is distinct
+            return list(maxima[:max_colors])
 
         result = []
 
+        # Accepted maxima by grid cell
+        grid = {}
+
         # Check for each maximum
         for m in maxima:
-            # This color is distinct until a color from before is too close
-            is_distinct = True
+            if max_colors is not None and len(result) >= max_colors:
+                break
 
-            for n in result:
-                # Compute delta components
-                r_delta = m.r - n.r
-                g_delta = m.g - n.g
-                b_delta = m.b - n.b
+            key = (int(m.r // threshold), int(m.g // threshold), int(m.b // threshold))
 
-                # Compute delta in color space distance
-                delta = math.sqrt(r_delta*r_delta + g_delta *
-                                  g_delta + b_delta*b_delta)
+            # This color is distinct until a color from before is too close
+            is_distinct = True
 
-                # If too close mark as non-distinct and break inner loop
-                if delta < self.distinct_threshold:
-                    is_distinct = False
+            for neighbour in self.neighbour_indices:
+                for n in grid.get((key[0] + neighbour[0], key[1] + neighbour[1], key[2] + neighbour[2]), ()):
+                    # Compute delta components
+                    r_delta = m.r - n.r
+                    g_delta = m.g - n.g
+                    b_delta = m.b - n.b
+
+                    # Compute delta in color space distance
+                    delta = math.sqrt(r_delta*r_delta + g_delta *
+                                      g_delta + b_delta*b_delta)
+
+                    # If too close mark as non-distinct and stop looking
+                    if delta < threshold:
+                        is_distinct = False
+                        break
+                if not is_distinct:
                     break
 
             # Add to filtered array if is distinct
-            if is_distinct == True:
+            if is_distinct:
                 result.append(m)
+                grid.setdefault(key, []).append(m)
 
         return result
-    
+
     def filter_too_similar(self, maxima , distinct_avoid_threshold=0.025):
         # Returns a filtered version of the specified array of maxima,
         # in which all entries are far enough away from the specified avoid_color
@@ -0,0 +1,183 @@
+import collections
+import numpy
+
+from .colorcube import ColorCube, LocalMaximum, neighbour_max
+
+
+class IncrementalColorCube(ColorCube):
+    # Color cube for frame streams (video, cameras) where consecutive images are almost identical.
+    # Pixels can be added and subtracted, and only the cells whose hit counts changed
+    # (plus their neighbours) are checked again when the local maxima are asked for.
+
+    # window keeps the histogram of the last window frames pushed with push_frame
+    # decay keeps an exponentially decayed histogram instead, every pushed frame
+    # multiplies the weight of all earlier ones with decay (0 < decay < 1)
+    # min_weight empties cells whose decayed weight dropped below it, this happens
+    # whenever the weights are renormalized (see renormalize_below)
+    # renormalize_below is the scale of the stored weights at which they are renormalized
+    def __init__(self, resolution=40, avoid_color=None, distinct_threshold=0.1, bright_threshold=0.012,
+                 channel_order="rgb", window=None, decay=None, min_weight=0.5, renormalize_below=1e-6):
+        ColorCube.__init__(self, resolution, avoid_color, distinct_threshold, bright_threshold,
+                           sparse=False, channel_order=channel_order)
+
+        if window is not None and decay is not None:
+            raise ValueError("window and decay can not be combined")
+        if decay is not None and not 0.0 < decay < 1.0:
+            raise ValueError("decay must be between 0 and 1, got %r" % (decay,))
+        self.window = window
+        self.decay = decay
+        self.min_weight = min_weight
+        self.renormalize_below = renormalize_below
+
+        # Cell sums of the frames in the window, subtracted once the frames leave it
+        self.frames = collections.deque()
+
+        # Decayed weights are stored divided by scale, so a new frame only touches its own cells.
+        # Scaling all weights by the same factor keeps every local maximum as it is.
+        self.scale = 1.0
+        if decay is not None:
+            self.hit_count = numpy.zeros(self.cell_count, dtype=numpy.float64)
+
+        # Hit counts are mirrored into the padded grid (see ColorCube.padded_index),
+        # so the 27 neighbours of any inner cell are at fixed offsets from its index
+        self.padded_hit_count = numpy.zeros(self.padded_resolution ** 3, dtype=self.hit_count.dtype)
+        self.is_inner = numpy.zeros(self.padded_resolution ** 3, dtype=bool)
+        self.is_inner[self.padded_index(numpy.arange(self.cell_count))] = True
+
+        # Local maximum flag of every padded cell and the cells changed since they were last updated
+        self.is_maximum = numpy.zeros(self.padded_resolution ** 3, dtype=bool)
+        self.changed = []
+
+    def unpadded_index(self, indices):
+        # Returns the linear cell index of the given indices of the padded grid
+        r = indices % self.padded_resolution - 1
+        g = indices // self.padded_resolution % self.padded_resolution - 1
+        b = indices // (self.padded_resolution * self.padded_resolution) - 1
+        return self.cell_index(r, g, b)
+
+    def clear_cells(self):
+        ColorCube.clear_cells(self)
+        self.frames.clear()
+        self.scale = 1.0
+        self.padded_hit_count.fill(0)
+        self.is_maximum.fill(False)
+        self.changed = []
+
+    def add(self, image):
+        # Adds all pixels of the image to the cube
+        self.add_cells(*self.pixel_cells(image))
+
+    def accumulate(self, image):
+        # Adds the image like add, so the padded grid and the changed cells stay up to date
+        # for current_local_maxima (callers like find_local_maxima_sampled go through accumulate)
+        self.add(image)
+
+    def subtract(self, image):
+        # Removes the pixels of an image that was added before
+        self.add_cells(*self.pixel_cells(image), weight=-1)
+
+    def push_frame(self, image):
+        # Adds the next frame of a stream and returns the colors of the window or decayed histogram
+        cells = self.pixel_cells(image)
+        if self.decay is not None:
+            self.scale *= self.decay
+            self.add_cells(*cells, weight=1.0 / self.scale)
+            if self.scale < self.renormalize_below:
+                self.renormalize()
+        else:
+            sums = self.add_cells(*cells)
+            if self.window is not None:
+                self.frames.append(sums)
+                if len(self.frames) > self.window:
+                    self.add_sums(self.frames.popleft(), weight=-1)
+        return self.colors_from_maxima(self.current_local_maxima())
+
+    def add_cells(self, index, r, g, b, weight=1):
+        # Adds pixels mapped by pixel_cells to the cells they fall into, multiplied by weight.
+        # Returns the per cell sums of the pixels, add_sums with weight -1 takes them out again.
+        cells, index = numpy.unique(index, return_inverse=True)
+        index = index.reshape(-1)
+        sums = (
+            cells,
+            numpy.bincount(index),
+            numpy.bincount(index, weights=r),
+            numpy.bincount(index, weights=g),
+            numpy.bincount(index, weights=b),
+        )
+        self.add_sums(sums, weight)
+        return sums
+
+    def add_sums(self, sums, weight=1):
+        # Adds hit counts and color sums of cells like ColorCube.add_sums, multiplied by weight.
+        # add_cells returns them in this form.
+        cells, hits, r, g, b = sums
+        if weight != 1:
+            hits = hits * weight
+            r = r * weight
+            g = g * weight
+            b = b * weight
+        self.hit_count[cells] += hits
+        self.r_acc[cells] += r
+        self.g_acc[cells] += g
+        self.b_acc[cells] += b
+
+        # Emptied cells start from exact zeros again, no rounding residue is left behind
+        empty = cells[self.hit_count[cells] <= 0]
+        self.hit_count[empty] = 0
+        self.r_acc[empty] = 0.0
+        self.g_acc[empty] = 0.0
+        self.b_acc[empty] = 0.0
+
+        padded = self.padded_index(cells)
+        self.padded_hit_count[padded] = self.hit_count[cells]
+        self.changed.append(padded)
+
+        # Hit cells are not tracked (subtracting empties them again), clear_cells goes over the whole grid
+        self.touched = None
+
+    def renormalize(self):
+        # Applies the scale to the stored weights and empties cells below min_weight
+        self.hit_count *= self.scale
+        self.r_acc *= self.scale
+        self.g_acc *= self.scale
+        self.b_acc *= self.scale
+        self.scale = 1.0
+        faded = self.hit_count < self.min_weight
+        self.hit_count[faded] = 0.0
+        self.r_acc[faded] = 0.0
+        self.g_acc[faded] = 0.0
+        self.b_acc[faded] = 0.0
+
+        # Rounding may have changed ties anywhere, so every cell is checked again
+        counts = self.hit_count.reshape(self.resolution, self.resolution, self.resolution)
+        is_maximum = ((counts > 0) & (counts >= neighbour_max(counts))).reshape(-1)
+        inner = self.padded_index(numpy.arange(self.cell_count))
+        self.padded_hit_count[inner] = self.hit_count
+        self.is_maximum[inner] = is_maximum
+        self.changed = []
+
+    def current_local_maxima(self):
+        # Finds and returns local maxima of the cells accumulated so far, sorted with respect to hit count.
+        # Only changed cells and their neighbours can have become or stopped being a local maximum.
+        if self.changed:
+            changed = numpy.unique(numpy.concatenate(self.changed))
+            self.changed = []
+            affected = numpy.unique((changed[:, None] + self.padded_offsets).reshape(-1))
+            affected = affected[self.is_inner[affected]]
+
+            # A cell with hits is a local maximum unless a neighbour has a higher hit count
+            hit_count = self.padded_hit_count[affected]
+            neighbour_count = self.padded_hit_count.take(affected + self.padded_offsets[:, None]).max(axis=0)
+            self.is_maximum[affected] = (hit_count > 0) & (hit_count >= neighbour_count)
+
+        maxima = self.local_maxima(self.unpadded_index(numpy.flatnonzero(self.is_maximum)))
+        if self.scale != 1.0:
+            # Report the decayed weights, not the stored ones
+            maxima = [LocalMaximum(m.hit_count * self.scale, m.cell_index, m.r, m.g, m.b) for m in maxima]
+        return maxima
+
+    def find_local_maxima(self, image):
+        # Finds and returns local maxima of a single image, like ColorCube does
+        self.clear_cells()
+        self.add(image)
+        return self.current_local_maxima()
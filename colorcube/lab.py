@@ -0,0 +1,143 @@
+import math
+import numpy
+
+from .colorcube import ColorCube
+
+# sRGB (D65) to CIE XYZ and the reference white
+RGB_TO_XYZ = numpy.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+XYZ_TO_RGB = numpy.linalg.inv(RGB_TO_XYZ)
+WHITE = numpy.array([0.95047, 1.0, 1.08883])
+
+# CIE constants of the Lab transfer function
+LAB_EPSILON = 216.0 / 24389.0
+LAB_KAPPA = 24389.0 / 27.0
+
+# Lab components are scaled to [0, 1] for the cube: L / 100, (a + 128) / 255, (b + 128) / 255
+LAB_OFFSET = numpy.array([0.0, 128.0, 128.0])
+LAB_SCALE = numpy.array([100.0, 255.0, 255.0])
+
+# Conversion tables by bits per component, shared by all cubes of a process
+_lab_tables = {}
+
+
+def rgb_to_lab(rgb):
+    # Converts 8 bit sRGB colors (... x 3, floats or ints in [0, 255]) to CIELAB
+    c = numpy.asarray(rgb, dtype=numpy.float64) / 255.0
+    linear = numpy.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    t = linear.dot(RGB_TO_XYZ.T) / WHITE
+    f = numpy.where(t > LAB_EPSILON, numpy.cbrt(t), (LAB_KAPPA * t + 16.0) / 116.0)
+    return numpy.stack((
+        116.0 * f[..., 1] - 16.0,
+        500.0 * (f[..., 0] - f[..., 1]),
+        200.0 * (f[..., 1] - f[..., 2]),
+    ), axis=-1)
+
+
+def lab_to_rgb(lab):
+    # Converts CIELAB colors (... x 3) to sRGB floats in [0, 255], clipped to the sRGB gamut
+    lab = numpy.asarray(lab, dtype=numpy.float64)
+    fy = (lab[..., 0] + 16.0) / 116.0
+    f = numpy.stack((fy + lab[..., 1] / 500.0, fy, fy - lab[..., 2] / 200.0), axis=-1)
+    t = numpy.where(f ** 3 > LAB_EPSILON, f ** 3, (116.0 * f - 16.0) / LAB_KAPPA)
+    linear = numpy.clip((t * WHITE).dot(XYZ_TO_RGB.T), 0.0, 1.0)
+    c = numpy.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1.0 / 2.4) - 0.055)
+    return numpy.clip(c * 255.0, 0.0, 255.0)
+
+
+def lab_table(bits=6):
+    # Returns the scaled Lab components (3 x 2**(3*bits) array) of every quantized RGB color,
+    # indexed with (r >> (8 - bits)) << 2*bits | (g >> (8 - bits)) << bits | (b >> (8 - bits)).
+    # Each entry holds the color at the center of its quantization step.
+    table = _lab_tables.get(bits)
+    if table is None:
+        size = 1 << bits
+        step = 1 << (8 - bits)
+        values = numpy.arange(size) * step + step // 2
+        rgb = numpy.stack(numpy.meshgrid(values, values, values, indexing="ij"), axis=-1).reshape(-1, 3)
+        table = numpy.ascontiguousarray(((rgb_to_lab(rgb) + LAB_OFFSET) / LAB_SCALE).clip(0.0, 1.0).T)
+        _lab_tables[bits] = table
+    return table
+
+
+class LabColorCube(ColorCube):
+    # Color cube binning pixels in CIELAB instead of RGB, so cells and distinct_threshold
+    # follow perceived color differences. Pixels are converted with a lookup table of
+    # quantized RGB colors (lab_bits per component), which also holds the cell of every entry,
+    # so mapping a pixel costs a few table lookups like in the RGB cube.
+    # The r, g and b fields of the maxima hold the scaled L, a and b components,
+    # get_colors still returns 8 bit RGB colors (the cell averages converted back).
+    # avoid_color is given in RGB, bright_threshold still applies to the RGB components.
+    def __init__(self, resolution=40, avoid_color=None, distinct_threshold=0.1, bright_threshold=0.012,
+                 sparse=None, channel_order="rgb", max_colors=None, lab_bits=6):
+        ColorCube.__init__(self, resolution, avoid_color, distinct_threshold, bright_threshold,
+                           sparse, channel_order, max_colors)
+
+        if not 1 <= lab_bits <= 7:
+            raise ValueError("lab_bits must be between 1 and 7, got %r" % (lab_bits,))
+        self.lab_bits = lab_bits
+        self.lab_shift = 8 - lab_bits
+        self.lab_components = lab_table(lab_bits)
+
+        # Cell index of every table entry
+        l_index, a_index, b_index = (self.lab_components * (float(resolution) - 1.0)).astype(numpy.intp)
+        self.lab_cells = self.cell_index(l_index, a_index, b_index)
+
+    def cube_params(self):
+        params = ColorCube.cube_params(self)
+        params["lab_bits"] = self.lab_bits
+        return params
+
+    def pixel_cells(self, image):
+        # Maps all pixels of the image to cells like ColorCube.pixel_cells,
+        # returning the scaled L, a and b components instead of r, g and b
+        channels = self.channels if isinstance(image, numpy.ndarray) else (0, 1, 2)
+        pixels = numpy.asarray(image)
+        if pixels.ndim < 2 or pixels.shape[-1] not in (3, 4):
+            raise ValueError("Expected an image with 3 or 4 channels, got shape %s" % (pixels.shape,))
+        pixels = pixels.reshape(-1, pixels.shape[-1])
+
+        r, g, b = (pixels[:, k] for k in channels)
+
+        # Colors that are darker than the threshold in every component go away
+        keep = (r >= self.dark_limit) | (g >= self.dark_limit) | (b >= self.dark_limit)
+        if not keep.all():
+            r, g, b = r[keep], g[keep], b[keep]
+
+        if pixels.shape[1] == 4:
+            # If image has alpha channel, weight colors by it (towards black) before converting
+            a = pixels[keep, 3].astype(numpy.uint16)
+            r, g, b = ((c * a // 255).astype(numpy.uint8) for c in (r, g, b))
+
+        # Index of the quantized color in the conversion table
+        shift, bits = self.lab_shift, self.lab_bits
+        entry = (r.astype(numpy.intp) >> shift) << (2 * bits)
+        entry |= (g.astype(numpy.intp) >> shift) << bits
+        entry |= b.astype(numpy.intp) >> shift
+
+        l_values, a_values, b_values = (component.take(entry) for component in self.lab_components)
+        return self.lab_cells.take(entry), l_values, a_values, b_values
+
+    def lab_colors(self, m):
+        # Returns the CIELAB colors (len(m) x 3 array) of local maxima
+        scaled = numpy.array([[n.r, n.g, n.b] for n in m], dtype=numpy.float64).reshape(-1, 3)
+        return scaled * LAB_SCALE - LAB_OFFSET
+
+    def maxima_colors(self, m):
+        # Converts local maxima to 8 bit RGB colors
+        return lab_to_rgb(self.lab_colors(m)).astype(int).tolist()
+
+    def filter_too_similar(self, maxima, distinct_avoid_threshold=0.025):
+        # Returns the maxima far enough away from avoid_color, compared in scaled Lab
+        al, aa, ab = (rgb_to_lab(self.avoid_color) + LAB_OFFSET) / LAB_SCALE
+
+        result = []
+        for m in maxima:
+            delta = math.sqrt((m.r - al)**2 + (m.g - aa)**2 + (m.b - ab)**2)
+            if delta > distinct_avoid_threshold:
+                result.append(m)
+
+        return result
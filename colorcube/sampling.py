@@ -0,0 +1,105 @@
+import math
+import numpy
+
+# Ways of picking the pixels that are counted
+SAMPLE_MODES = ("stride", "random", "stratified")
+
+
+def sample_grid(height, width, sample_size):
+    # Returns (rows, columns) of a grid over an image of height x width pixels with at most
+    # sample_size points, about as many as possible, spaced about the same in both directions
+    rows = min(height, sample_size, max(1, int(round(math.sqrt(sample_size * height / float(width))))))
+    columns = min(width, max(1, sample_size // rows))
+    return rows, columns
+
+
+def sample_pixels(image, sample_size, mode="stride", seed=None):
+    # Returns about sample_size pixels of the image (never more), as an array with the
+    # channels of the image in the last dimension. Images with fewer pixels are returned whole.
+    # stride takes every n-th pixel of every m-th row, a regular grid over the image.
+    # random takes sample_size distinct pixels drawn uniformly with seed.
+    # stratified splits the image into sample_size tiles of about the same size and shape
+    # and takes one random pixel of each, so every region of the image is represented.
+    if mode not in SAMPLE_MODES:
+        raise ValueError("mode must be one of %s, got %r" % (SAMPLE_MODES, mode))
+    pixels = numpy.asarray(image)
+    height, width = pixels.shape[:2]
+    if sample_size <= 0:
+        raise ValueError("sample_size must be positive, got %r" % (sample_size,))
+    if height * width <= sample_size:
+        return pixels
+
+    # Rows and columns of the grid (or tiles) keep the aspect ratio of the image
+    rows, columns = sample_grid(height, width, sample_size)
+    if mode == "stride":
+        # Steps of ceil(height / rows) give at most rows rows, the same for columns
+        row_step = int(math.ceil(height / float(rows)))
+        column_step = int(math.ceil(width / float(columns)))
+        return pixels[::row_step, ::column_step]
+
+    rng = numpy.random.default_rng(seed)
+    if mode == "random":
+        # Sorted positions keep the reads in memory order, indexing rows and columns
+        # reads cropped views of an image without copying it
+        positions = numpy.sort(rng.choice(height * width, sample_size, replace=False))
+        return pixels[positions // width, positions % width]
+
+    row_edges = numpy.linspace(0, height, rows + 1).astype(numpy.intp)
+    column_edges = numpy.linspace(0, width, columns + 1).astype(numpy.intp)
+    row = row_edges[:-1, None] + (rng.random((rows, columns)) * numpy.diff(row_edges)[:, None]).astype(numpy.intp)
+    column = column_edges[None, :-1] + (rng.random((rows, columns)) * numpy.diff(column_edges)[None, :]).astype(numpy.intp)
+    return pixels[row, column]
+
+
+def frequency_error_bound(sample_size, confidence=0.95):
+    # Returns the Hoeffding bound eps on the error of one cell's share of the pixels:
+    # with uniform random sampling, |sampled share - true share| <= eps with probability
+    # confidence. stride and stratified samples usually do better on natural images, but
+    # the bound only holds for random ones.
+    return math.sqrt(math.log(2.0 / (1.0 - confidence)) / (2.0 * sample_size))
+
+
+def find_local_maxima_sampled(color_cube, image, sample_size, mode="stride", seed=None):
+    # Finds and returns local maxima of the image like ColorCube.find_local_maxima,
+    # counting only the pixels picked by sample_pixels
+    samples = sample_pixels(image, sample_size, mode, seed)
+    if not isinstance(image, numpy.ndarray) and color_cube.channels != (0, 1, 2):
+        # PIL images are always rgb, the sampled array is read in channel_order
+        samples = samples[..., list(color_cube.channels) + list(range(3, samples.shape[-1]))]
+    color_cube.clear_cells()
+    color_cube.accumulate(samples)
+    return color_cube.current_local_maxima()
+
+
+def get_colors_sampled(color_cube, image, sample_size, mode="stride", seed=None):
+    # Returns the colors of the image like ColorCube.get_colors, see sample_pixels
+    return color_cube.colors_from_maxima(find_local_maxima_sampled(color_cube, image, sample_size, mode, seed))
+
+
+def sampling_error(color_cube, image, sample_size, mode="stride", seed=None):
+    # Measures how far the sampled result of the image is from the one counting every pixel.
+    # Returns (share_error, color_error):
+    # share_error is the largest difference of a cell's share of the counted pixels,
+    # the quantity frequency_error_bound bounds.
+    # color_error is the largest distance (in 8 bit RGB) from a color found with all pixels
+    # to the nearest color found in the sample, infinite if the sample found no colors.
+    full_maxima = color_cube.find_local_maxima(image)
+    full_counts = color_cube.hit_count.astype(numpy.float64)
+    full_colors = numpy.array(color_cube.colors_from_maxima(full_maxima), dtype=numpy.float64).reshape(-1, 3)
+
+    sampled_maxima = find_local_maxima_sampled(color_cube, image, sample_size, mode, seed)
+    sampled_counts = color_cube.hit_count.astype(numpy.float64)
+    sampled_colors = numpy.array(color_cube.colors_from_maxima(sampled_maxima), dtype=numpy.float64).reshape(-1, 3)
+
+    share_error = 0.0
+    if full_counts.sum() > 0 and sampled_counts.sum() > 0:
+        share_error = float(numpy.abs(full_counts / full_counts.sum() - sampled_counts / sampled_counts.sum()).max())
+
+    if not len(full_colors):
+        color_error = 0.0
+    elif not len(sampled_colors):
+        color_error = float("inf")
+    else:
+        distances = numpy.sqrt(((full_colors[:, None] - sampled_colors[None]) ** 2).sum(axis=2))
+        color_error = float(distances.min(axis=1).max())
+    return share_error, color_error
@@ -0,0 +1,143 @@
+import os
+import numpy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+# Color cubes of a worker process, by type and the parameters that change how pixels map to cells
+_worker_cubes = {}
+
+
+def tile_bounds(height, tiles):
+    # Returns (first row, end row) of each of the horizontal tiles an image is split into
+    edges = numpy.linspace(0, height, min(tiles, max(height, 1)) + 1).astype(int)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def tile_histogram(color_cube, tile):
+    # Returns the hit counts and r, g, b sums of the pixels of tile for the cells they fall into,
+    # as (sorted distinct cells, hit counts, r, g, b sums) like ColorCube.add_sums takes them.
+    # Only cells that were hit are kept, so a partial never holds more cells than its tile has pixels.
+    index, r, g, b = color_cube.pixel_cells(tile)
+    if color_cube.sparse:
+        # Count per distinct cell like sparse accumulation, no cell_count arrays are made
+        cells, index = numpy.unique(index, return_inverse=True)
+        index = index.reshape(-1)
+        return (
+            cells,
+            numpy.bincount(index),
+            numpy.bincount(index, weights=r),
+            numpy.bincount(index, weights=g),
+            numpy.bincount(index, weights=b),
+        )
+
+    # Counts up to the highest cell hit, then only the cells that were hit
+    hits = numpy.bincount(index)
+    cells = numpy.flatnonzero(hits)
+    return (
+        cells,
+        hits[cells],
+        numpy.bincount(index, weights=r)[cells],
+        numpy.bincount(index, weights=g)[cells],
+        numpy.bincount(index, weights=b)[cells],
+    )
+
+
+def merge_partials(partials):
+    # Merges the sums of several tiles (see tile_histogram) into one, with one bincount per field
+    # over the concatenated cells
+    cells, index = numpy.unique(numpy.concatenate([partial[0] for partial in partials]), return_inverse=True)
+    index = index.reshape(-1)
+    hits, r, g, b = (
+        numpy.bincount(index, weights=numpy.concatenate([partial[field] for partial in partials]),
+                       minlength=len(cells))
+        for field in range(1, 5)
+    )
+    return cells, hits.astype(numpy.int64), r, g, b
+
+
+def _shared_tile_histogram(cube_key, image_name, shape, dtype, rows):
+    # Runs in a worker process: reads its rows from the shared image and returns the sums
+    # of its tile, only the image is passed through shared memory
+    color_cube = _worker_cubes.get(cube_key)
+    if color_cube is None:
+        cube_type, cube_params = cube_key
+        color_cube = cube_type(**dict(cube_params))
+        _worker_cubes[cube_key] = color_cube
+
+    image_memory = shared_memory.SharedMemory(name=image_name)
+    try:
+        image = numpy.ndarray(shape, dtype=dtype, buffer=image_memory.buf)
+        partial = tile_histogram(color_cube, image[rows[0]:rows[1]])
+        # Views of the buffer have to go before the shared memory can be closed
+        del image
+    finally:
+        image_memory.close()
+    return partial
+
+
+def accumulate_tiled(color_cube, image, workers=None, tiles=None, processes=False, executor=None):
+    # Adds all pixels of the image to the cells of color_cube like ColorCube.accumulate,
+    # but splits the image into tiles of rows whose partial histograms are counted in parallel
+    # and merged at the end, which color_cube.add_sums adds to its cells. Partials only hold
+    # the cells their tile hit, so sparse cubes stay sparse.
+    # workers is the number of threads (or processes), all cores by default.
+    # tiles is the number of tiles, workers by default.
+    # processes counts tiles in worker processes, the image is passed through shared memory
+    # and the partial histograms are sent back. The workers rebuild the cube from type(color_cube)
+    # and color_cube.cube_params(). Threads share them anyway, but only parts of the
+    # counting run without the GIL.
+    # executor is a ThreadPoolExecutor or ProcessPoolExecutor to reuse across images.
+    pixels = numpy.asarray(image)
+    if not isinstance(image, numpy.ndarray) and color_cube.channels != (0, 1, 2):
+        # PIL images are always rgb, the tiles are arrays read in channel_order
+        pixels = pixels[..., list(color_cube.channels) + list(range(3, pixels.shape[-1]))]
+    pixels = numpy.ascontiguousarray(pixels)
+    workers = workers or os.cpu_count() or 1
+    bounds = tile_bounds(pixels.shape[0], tiles or workers)
+
+    own_executor = executor is None
+    if own_executor:
+        executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(workers)
+    try:
+        if processes:
+            partials = _process_partials(color_cube, pixels, bounds, executor)
+        else:
+            partials = list(executor.map(
+                lambda rows: tile_histogram(color_cube, pixels[rows[0]:rows[1]]), bounds))
+    finally:
+        if own_executor:
+            executor.shutdown()
+
+    # One reduction over all tiles, the cube adds it to its cells in its own way
+    color_cube.add_sums(merge_partials(partials))
+
+
+def _process_partials(color_cube, pixels, bounds, executor):
+    # Counts the tiles in worker processes, returns their sums
+    cube_key = (type(color_cube), tuple(sorted(color_cube.cube_params().items())))
+    image_memory = shared_memory.SharedMemory(create=True, size=max(pixels.nbytes, 1))
+    try:
+        numpy.ndarray(pixels.shape, dtype=pixels.dtype, buffer=image_memory.buf)[...] = pixels
+        futures = [
+            executor.submit(_shared_tile_histogram, cube_key, image_memory.name, pixels.shape,
+                            pixels.dtype.str, rows)
+            for rows in bounds
+        ]
+        partials = [future.result() for future in futures]
+    finally:
+        image_memory.close()
+        image_memory.unlink()
+    return partials
+
+
+def find_local_maxima_tiled(color_cube, image, **kwargs):
+    # Finds and returns local maxima of the image like ColorCube.find_local_maxima,
+    # counting the pixels with accumulate_tiled (which takes the keyword arguments)
+    color_cube.clear_cells()
+    accumulate_tiled(color_cube, image, **kwargs)
+    return color_cube.current_local_maxima()
+
+
+def get_colors_tiled(color_cube, image, **kwargs):
+    # Returns the colors of the image like ColorCube.get_colors, see accumulate_tiled
+    return color_cube.colors_from_maxima(find_local_maxima_tiled(color_cube, image, **kwargs))
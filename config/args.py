@@ -1,7 +1,7 @@
 import argparse
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description="Color Classify Images")
     parser.add_argument("input_dir", type=str, help="dir containing images")
     parser.add_argument(
@@ -36,4 +36,146 @@ def get_args():
         type=int,
         help="size of resized image to pass through color cube",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="number of processes analysing images, files are still copied by the main process",
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="also read images from subdirectories of input_dir",
+    )
+    parser.add_argument(
+        "--color_lut_dir",
+        default=None,
+        help="dir to cache the RGB to munsell color lookup table in, colors are matched without a table if not given",
+    )
+    parser.add_argument(
+        "--color_lut_bits",
+        default=8,
+        type=int,
+        choices=range(1, 9),
+        metavar="[1-8]",
+        help="bits per color component of the lookup table, 8 is exact, 6 is smaller and faster to build",
+    )
+    parser.add_argument(
+        "--color_space",
+        default="rgb",
+        choices=["rgb", "lab"],
+        help="lab bins colors and matches them to the palette in CIELAB, closer to perceived differences",
+    )
+    parser.add_argument(
+        "--bbox_method",
+        default="contours",
+        choices=["contours", "components"],
+        help="components finds the largest object with connected components, faster on noisy masks",
+    )
+    parser.add_argument(
+        "--bbox_scale",
+        default=1.0,
+        type=float,
+        help="scale of the mask the components are found on, e.g. 0.25 for large images",
+    )
+    parser.add_argument(
+        "--sample_mode",
+        default=None,
+        choices=["stride", "random", "stratified"],
+        help="count a sample of sample_size pixels of each image instead of resizing it to image_resize",
+    )
+    parser.add_argument(
+        "--sample_size",
+        default=10000,
+        type=int,
+        help="number of pixels sampled per image with sample_mode",
+    )
+    parser.add_argument(
+        "--sample_seed",
+        default=0,
+        type=int,
+        help="seed of random and stratified samples",
+    )
+    parser.add_argument(
+        "--decode",
+        default="full",
+        choices=["full", "reduced"],
+        help="reduced decodes large JPEGs at 1/2, 1/4 or 1/8 scale, use full to compare results",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="sqlite file to cache results in, images with a cached result are not analysed again",
+    )
+    parser.add_argument(
+        "--cache_size",
+        default=1000000,
+        type=int,
+        help="max number of cached results, least recently used results are evicted first",
+    )
+    parser.add_argument(
+        "--cache_key",
+        default="stat",
+        choices=["stat", "content"],
+        help="identify images by path, size and mtime (stat) or by a hash of the file (content)",
+    )
+    parser.add_argument(
+        "--output_mode",
+        default="copy",
+        choices=["copy", "hardlink", "symlink", "reflink", "move", "manifest-only"],
+        help="how images are placed in the color dirs, links fall back to copies where not possible, "
+        "manifest-only writes a manifest to output_dir instead",
+    )
+    parser.add_argument(
+        "--manifest_format",
+        default="csv",
+        choices=["csv", "jsonl", "parquet"],
+        help="file format of the manifest-only output, parquet needs pyarrow",
+    )
+    parser.add_argument(
+        "--manifest_top_k",
+        default=5,
+        type=int,
+        help="number of colors per image (with their hit counts) written to the manifest",
+    )
+    parser.add_argument(
+        "--pipeline",
+        default="sync",
+        choices=["sync", "async"],
+        help="async reads files, analyses images (in --workers processes or one thread) "
+        "and writes outputs concurrently, for storage with high latency",
+    )
+    parser.add_argument(
+        "--readers",
+        default=8,
+        type=int,
+        help="number of files read at a time by the async pipeline",
+    )
+    parser.add_argument(
+        "--writers",
+        default=1,
+        type=int,
+        help="number of output files placed at a time",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print a progress line while running and per-stage timings at the end",
+    )
+    parser.add_argument(
+        "--stats_interval",
+        default=10.0,
+        type=float,
+        help="seconds between progress lines of --stats",
+    )
+    parser.add_argument(
+        "--stats_json",
+        default=None,
+        help="file to write per-stage timings and throughput to as JSON",
+    )
+    parser.add_argument(
+        "--stats_prometheus",
+        default=None,
+        help="file to write per-stage timings and throughput to in the Prometheus textfile format",
+    )
+    return parser.parse_args(argv)
@@ -3,7 +3,22 @@ from pathlib import Path
 
 ACCEPTED_IMAGE_EXTENTIONS = ("*.jpg", "*.jpeg", "*.png", "*.JPG", "*.PNG", "*.JPEG")
 
-# open color name/characteristics file
+# color name/characteristics file
 root = Path(__file__).resolve().parent.parent
-with open(str(root / "color_groupings" / "munsell_rgb_non_color.csv"), "r") as my_file:
-    color_list = list(csv.reader(my_file))
+COLOR_LIST_PATH = root / "color_groupings" / "munsell_rgb_non_color.csv"
+
+
+def load_color_list(path=COLOR_LIST_PATH):
+    """ read the color name/characteristics file, one [name, r, g, b] list of strings per color """
+    with open(str(path), "r") as my_file:
+        return list(csv.reader(my_file))
+
+
+def __getattr__(name):
+    # color_list is read on first access, importing this module for other constants
+    # (e.g. ACCEPTED_IMAGE_EXTENTIONS) doesn't touch the color file
+    if name == "color_list":
+        color_list = load_color_list()
+        globals()["color_list"] = color_list
+        return color_list
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -1,21 +1,56 @@
 import cv2
 import numpy as np
 
+from utils.instrumentation import NULL_STATS
+
+# ways of finding the largest object of an image, see ImageCrop
+BBOX_METHODS = ("contours", "components")
+
 
 class ImageCrop(object):
+    """
+    Crop segmented images (black background) to the object they show
+        bbox_method:
+            contours - bounding box of the contour with the largest area (get_largest_bbox)
+            components - bounding box of the connected component with the most pixels
+            (get_largest_component_bbox), much faster on images with speckle noise
+        bbox_scale - components only, find the component on the mask scaled by this factor
+    """
+
     def __init__(
-        self, min_side_length, iterator_size=1, min_crop=50, boundary_threshold=0.0
+        self,
+        min_side_length,
+        iterator_size=1,
+        min_crop=50,
+        boundary_threshold=0.0,
+        bbox_method="contours",
+        bbox_scale=1.0,
     ):
+        assert bbox_method in BBOX_METHODS, "bbox_method must be one of {}".format(
+            BBOX_METHODS
+        )
+        assert 0.0 < bbox_scale <= 1.0, "bbox_scale must be in (0, 1]"
         self.iterator_size = iterator_size
         self.min_side_length = min_side_length
         self.min_crop = min_crop
         self.boundary_threshold = boundary_threshold
+        self.bbox_method = bbox_method
+        self.bbox_scale = bbox_scale
 
-    def crop_image(self, image):
+    def crop_image(self, image, stats=NULL_STATS):
+        """
+        crop image to its largest contour, then trim black borders
+            returns None if the image could not be cropped or is smaller than min_side_length
+            stats times the bbox and twoside_crop stages (see utils.instrumentation)
+        """
         try:
-            image = self.get_largest_bbox(image)
+            with stats.stage("bbox"):
+                if self.bbox_method == "components":
+                    image = self.get_largest_component_bbox(image, self.bbox_scale)
+                else:
+                    image = self.get_largest_bbox(image)
         except Exception as e:
-            print("Error: ", e, img_path)
+            print("Error: ", e)
             return None
         if (
             image.shape[0] < self.min_side_length
@@ -23,9 +58,10 @@ class ImageCrop(object):
         ):
             image = None
         else:
-            image = self.iterative_twoside_crop(
-                image, self.iterator_size, self.min_crop, self.boundary_threshold
-            )
+            with stats.stage("twoside_crop"):
+                image = self.iterative_twoside_crop(
+                    image, self.iterator_size, self.min_crop, self.boundary_threshold
+                )
         return image
 
     @staticmethod
@@ -41,6 +77,51 @@ class ImageCrop(object):
         x, y, w, h = cv2.boundingRect(biggest_contour)
         return image[y : y + h, x : x + w, :]
 
+    @staticmethod
+    def get_largest_component_bbox(image, scale=1.0):
+        """
+        returns cropped image that fits the largest 8-connected group of non black pixels
+            Components are ranked by their number of pixels, contours by the area they enclose,
+            so the boxes only differ if a blob with large holes loses against a solid one
+            With scale < 1 the components are found on a downscaled mask (every block with a
+            non black pixel is set), the box is then scaled back and trimmed to the rows and
+            columns in it that have non black pixels. The mask is opened with a 3x3 kernel
+            first, so speckle noise does not join into one blob and is trimmed off the box.
+            Blocks can join blobs that are a few pixels apart, and the opening removes parts
+            of the object thinner than 3 pixels, so the box may be a few pixels off the one
+            found at full size
+        """
+        img_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        img_mask = cv2.inRange(img_gray, 1, 255)
+        mask = img_mask
+        if scale < 1.0:
+            opened = cv2.morphologyEx(img_mask, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
+            if opened.any():
+                img_mask = opened
+                mask = cv2.resize(img_mask, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                mask = cv2.inRange(mask, 1, 255)
+        count, _, component_stats, _ = cv2.connectedComponentsWithStats(
+            mask, connectivity=8
+        )
+        if count < 2:
+            raise ValueError("no foreground pixels to crop to")
+        # label 0 is the background
+        largest = 1 + int(np.argmax(component_stats[1:, cv2.CC_STAT_AREA]))
+        x, y, w, h = component_stats[largest, :4]
+        if mask is img_mask:
+            return image[y : y + h, x : x + w, :]
+
+        # blocks of the scaled mask cover [x / scale, (x + w) / scale) of the image
+        height, width = img_mask.shape
+        x0, y0 = int(np.floor(x / scale)), int(np.floor(y / scale))
+        x1 = min(width, int(np.ceil((x + w) / scale)))
+        y1 = min(height, int(np.ceil((y + h) / scale)))
+        rows = np.flatnonzero(img_mask[y0:y1, x0:x1].any(axis=1))
+        columns = np.flatnonzero(img_mask[y0:y1, x0:x1].any(axis=0))
+        return image[
+            y0 + rows[0] : y0 + rows[-1] + 1, x0 + columns[0] : x0 + columns[-1] + 1, :
+        ]
+
     @staticmethod
     def iterative_twoside_crop(
         image, iterator=1, min_crop=(80, 80), boundary_thresh=0.1
@@ -60,6 +141,8 @@ class ImageCrop(object):
             iterator: size of crop made on given side
             min_crop: minimum size image can be cropped to
             boundary_thresh: percentage of black pixels allowed on boundary of new cropped image
+        Black pixels are counted once up front in a summed-area table,
+            so each step only looks up four counts instead of summing image slices
         """
         assert isinstance(
             min_crop, (int, list, tuple)
@@ -70,18 +153,28 @@ class ImageCrop(object):
         img_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         img_gray = cv2.GaussianBlur(img_gray, (5, 5), 0)
         y_lim, x_lim = image.shape[0], image.shape[1]
+        # black_sum[y, x] is the number of black pixels in rows [0, y) and columns [0, x)
+        black_sum = cv2.integral((img_gray == 0).view(np.uint8))
+
+        def black_pixels(y0, y1, x0, x1):
+            # number of black pixels in rows [y0, y1) and columns [x0, x1)
+            return int(
+                black_sum[y1, x1] - black_sum[y0, x1] - black_sum[y1, x0] + black_sum[y0, x0]
+            )
+
         x_top, y_top = 0, 0
         y_bot, x_bot = y_lim - 1, x_lim - 1
         min_rectangle = False
         cropped = False
         while not min_rectangle:
             # and top_row > bp_threshold*x_top-x_bot applies black pixel threshold
-            top_row = np.sum(img_gray[y_top, x_top:x_bot] == 0)
-            bot_row = np.sum(img_gray[y_bot, x_top:x_bot] == 0)
-            left_col = np.sum(img_gray[y_top:y_bot, x_top] == 0)
-            right_col = np.sum(img_gray[y_top:y_bot, x_bot] == 0)
-            row_index = np.argmax([top_row, bot_row])
-            col_index = np.argmax([left_col, right_col])
+            top_row = black_pixels(y_top, y_top + 1, x_top, x_bot)
+            bot_row = black_pixels(y_bot, y_bot + 1, x_top, x_bot)
+            left_col = black_pixels(y_top, y_bot, x_top, x_top + 1)
+            right_col = black_pixels(y_top, y_bot, x_bot, x_bot + 1)
+            # pick the side with more black pixels, the first one on ties
+            row_index = 0 if top_row >= bot_row else 1
+            col_index = 0 if left_col >= right_col else 1
 
             if (
                 not (
@@ -0,0 +1,355 @@
+"""
+Check the optimized code paths against the original pure Python algorithms
+    The reference_* functions below are the loops the repo started with. ColorCube (dense,
+    sparse, bgr, tiled, incremental and sampled with a budget of all pixels),
+    filter_distinct_maxima, ImageCrop (also on speckled masks) and get_nearest_color are run on synthetic images
+    and compared with them. Exits with status 1 if any result differs
+    (NOTE: tiled and incremental cubes sum colors in another order, their average colors
+    may differ in the last bits, so colors are compared within 1 of 255 there)
+    Arguments:
+        images - number of random images per check
+        seed - seed of the random images
+"""
+import argparse
+import math
+import sys
+
+import cv2
+import numpy as np
+
+from benchmark import IMAGE_KINDS, make_image
+from colorcube.colorcube import ColorCube
+from colorcube.incremental import IncrementalColorCube
+from colorcube.sampling import find_local_maxima_sampled
+from colorcube.tiling import find_local_maxima_tiled
+from config.constants import color_list
+from crop.imagecrop import ImageCrop
+from utils.color_functions import (
+    AchromaticColorIndex,
+    build_color_lut,
+    get_nearest_color,
+    is_color_gray,
+)
+
+
+def reference_find_local_maxima(pixels, resolution=40, bright_threshold=0.012):
+    """
+    ColorCube.find_local_maxima as it was, pixels is a list of (r, g, b[, a]) tuples
+        returns (hit_count, cell_index, r, g, b) of each maximum, sorted by hit count
+    """
+    cell_count = resolution ** 3
+    hit_count = [0] * cell_count
+    r_acc = [0.0] * cell_count
+    g_acc = [0.0] * cell_count
+    b_acc = [0.0] * cell_count
+    for p in pixels:
+        r = float(p[0]) / 255.0
+        g = float(p[1]) / 255.0
+        b = float(p[2]) / 255.0
+        if r < bright_threshold and g < bright_threshold and b < bright_threshold:
+            continue
+        if len(p) == 4:
+            a = float(p[3]) / 255.0
+            r *= a
+            g *= a
+            b *= a
+        index = (
+            int(r * (float(resolution) - 1.0))
+            + int(g * (float(resolution) - 1.0)) * resolution
+            + int(b * (float(resolution) - 1.0)) * resolution * resolution
+        )
+        hit_count[index] += 1
+        r_acc[index] += r
+        g_acc[index] += g
+        b_acc[index] += b
+
+    local_maxima = []
+    for r in range(resolution):
+        for g in range(resolution):
+            for b in range(resolution):
+                local_index = r + g * resolution + b * resolution * resolution
+                local_hit_count = hit_count[local_index]
+                if local_hit_count == 0:
+                    continue
+                is_local_maximum = True
+                for dr in (0, 1, -1):
+                    for dg in (0, 1, -1):
+                        for db in (0, 1, -1):
+                            nr, ng, nb = r + dr, g + dg, b + db
+                            if (
+                                0 <= nr < resolution
+                                and 0 <= ng < resolution
+                                and 0 <= nb < resolution
+                                and hit_count[nr + ng * resolution + nb * resolution * resolution]
+                                > local_hit_count
+                            ):
+                                is_local_maximum = False
+                if is_local_maximum:
+                    local_maxima.append(
+                        (
+                            local_hit_count,
+                            local_index,
+                            r_acc[local_index] / float(local_hit_count),
+                            g_acc[local_index] / float(local_hit_count),
+                            b_acc[local_index] / float(local_hit_count),
+                        )
+                    )
+    return sorted(local_maxima, key=lambda x: x[0], reverse=True)
+
+
+def reference_filter_distinct_maxima(maxima, distinct_threshold):
+    """ ColorCube.filter_distinct_maxima as it was, comparing with every accepted maximum """
+    result = []
+    for m in maxima:
+        is_distinct = True
+        for n in result:
+            delta = math.sqrt((m.r - n.r) ** 2 + (m.g - n.g) ** 2 + (m.b - n.b) ** 2)
+            if delta < distinct_threshold:
+                is_distinct = False
+                break
+        if is_distinct:
+            result.append(m)
+    return result
+
+
+def reference_twoside_crop(image, iterator=1, min_crop=50, boundary_thresh=0.0):
+    """ ImageCrop.iterative_twoside_crop as it was, summing the border pixels each step """
+    img_gray = cv2.GaussianBlur(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    x_top, y_top = 0, 0
+    y_bot, x_bot = image.shape[0] - 1, image.shape[1] - 1
+    while True:
+        top_row = np.sum(img_gray[y_top, x_top:x_bot] == 0)
+        bot_row = np.sum(img_gray[y_bot, x_top:x_bot] == 0)
+        left_col = np.sum(img_gray[y_top:y_bot, x_top] == 0)
+        right_col = np.sum(img_gray[y_top:y_bot, x_bot] == 0)
+        row_index = np.argmax([top_row, bot_row])
+        col_index = np.argmax([left_col, right_col])
+        cropped = False
+        if row_index == 0 and not (
+            y_bot - y_top - 1 <= min_crop or boundary_thresh * (x_bot - x_top) >= top_row
+        ):
+            y_top += iterator
+            cropped = True
+        if row_index == 1 and not (
+            y_bot - y_top - 1 <= min_crop or boundary_thresh * (x_bot - x_top) >= bot_row
+        ):
+            y_bot -= iterator
+            cropped = True
+        if col_index == 0 and not (
+            x_bot - x_top - 1 <= min_crop or boundary_thresh * (y_bot - y_top) >= left_col
+        ):
+            x_top += iterator
+            cropped = True
+        if col_index == 1 and not (
+            x_bot - x_top - 1 <= min_crop or boundary_thresh * (y_bot - y_top) >= right_col
+        ):
+            x_bot -= iterator
+            cropped = True
+        if not cropped:
+            return y_top, y_bot, x_top, x_bot
+
+
+def reference_nearest_color(color, color_list):
+    """ get_nearest_color as it was for a single color, comparing with every palette color """
+    min_index = None
+    if color[0] <= 35 and color[1] <= 35 and color[2] <= 35:
+        min_index = AchromaticColorIndex.Black
+    elif color[0] > 240 and color[1] > 240 and color[2] > 240:
+        min_index = AchromaticColorIndex.White
+    elif all(168 < c < 230 for c in color):
+        if is_color_gray(color):
+            min_index = AchromaticColorIndex.LightGray
+    elif all(60 < c < 132 for c in color):
+        if is_color_gray(color):
+            min_index = AchromaticColorIndex.DarkGrey
+    if not min_index:
+        color = np.array(color[:3])
+        distances = [
+            np.linalg.norm(color - np.array((int(c[1]), int(c[2]), int(c[3]))))
+            for c in color_list[:-2]
+        ]
+        min_index = np.argmin(distances)
+    return color_list[min_index][0]
+
+
+def random_images(count, seed):
+    """
+    Yield (description, image) of count random rgb/rgba images
+        synthetic images from the benchmark and images of a few colors,
+        which give many cells with equal hit counts
+    """
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        kind = (IMAGE_KINDS + ("palette",))[i % (len(IMAGE_KINDS) + 1)]
+        if kind == "palette":
+            channels = 4 if i % 2 else 3
+            palette = rng.integers(0, 256, (int(rng.integers(3, 60)), channels), dtype=np.uint8)
+            image = palette[rng.integers(0, len(palette), (60, 70))]
+        else:
+            image = make_image(kind, 48, seed + i)
+        yield "{} #{}".format(kind, i), image
+
+
+def maxima_signature(maxima, exact=True):
+    """ comparable tuples of maxima, colors scaled to 8 bit and rounded unless exact """
+    if exact:
+        return [(m.hit_count, m.cell_index, m.r, m.g, m.b) for m in maxima]
+    return [(m.hit_count, m.cell_index) for m in maxima]
+
+
+def colors_close(maxima, expected):
+    """ whether the average colors of maxima are within 1 of 255 of the expected ones """
+    return all(
+        abs(m.r - e[2]) * 255.0 <= 1.0
+        and abs(m.g - e[3]) * 255.0 <= 1.0
+        and abs(m.b - e[4]) * 255.0 <= 1.0
+        for m, e in zip(maxima, expected)
+    )
+
+
+def check_color_cube(count, seed):
+    """ yield a message for each color cube result that differs from the reference """
+    for resolution in (40, 13):
+        cubes = {
+            "dense": ColorCube(resolution),
+            "sparse": ColorCube(resolution, sparse=True),
+            "bgr": ColorCube(resolution, channel_order="bgr"),
+            "incremental": IncrementalColorCube(resolution),
+        }
+        for name, image in random_images(count, seed):
+            pixels = [tuple(p) for p in image.reshape(-1, image.shape[-1]).tolist()]
+            expected = reference_find_local_maxima(pixels, resolution)
+            where = "{} at resolution {}".format(name, resolution)
+            bgr_image = image[..., [2, 1, 0] + list(range(3, image.shape[-1]))]
+
+            results = {
+                "dense": cubes["dense"].find_local_maxima(image),
+                "sparse": cubes["sparse"].find_local_maxima(image),
+                "bgr": cubes["bgr"].find_local_maxima(bgr_image),
+                "sampled": find_local_maxima_sampled(cubes["dense"], image, image.size),
+            }
+            for mode, maxima in results.items():
+                if maxima_signature(maxima) != expected:
+                    yield "ColorCube {} differs for {}".format(mode, where)
+
+            # colors are summed in another order by these
+            approximate = {
+                "tiled": find_local_maxima_tiled(cubes["dense"], image, workers=2, tiles=3),
+                "incremental tiled": find_local_maxima_tiled(cubes["incremental"], image, workers=2, tiles=3),
+                "incremental": cubes["incremental"].find_local_maxima(image),
+            }
+            cubes["incremental"].clear_cells()
+            cubes["incremental"].accumulate(image)
+            approximate["incremental accumulate"] = cubes["incremental"].current_local_maxima()
+            for mode, maxima in approximate.items():
+                if maxima_signature(maxima, exact=False) != [e[:2] for e in expected] or not colors_close(
+                    maxima, expected
+                ):
+                    yield "ColorCube {} differs for {}".format(mode, where)
+
+
+def check_filter_distinct_maxima(count, seed):
+    color_cube = ColorCube()
+    for threshold in (0.1, 0.03, 0.2):
+        color_cube.distinct_threshold = threshold
+        for name, image in random_images(count, seed):
+            maxima = color_cube.find_local_maxima(image)
+            expected = reference_filter_distinct_maxima(maxima, threshold)
+            if color_cube.filter_distinct_maxima(maxima) != expected:
+                yield "filter_distinct_maxima differs for {} with threshold {}".format(name, threshold)
+
+
+def crop_box(image, cropped):
+    """ (offset in bytes, shape) of a crop, which is a view of image """
+    offset = cropped.__array_interface__["data"][0] - image.__array_interface__["data"][0]
+    return offset, cropped.shape
+
+
+def component_box(image, scale):
+    """ (top, left, bottom, right) of the box get_largest_component_bbox crops to """
+    offset, shape = crop_box(image, ImageCrop.get_largest_component_bbox(image, scale))
+    top, left = divmod(offset // image.shape[2], image.shape[1])
+    return top, left, top + shape[0], left + shape[1]
+
+
+def check_crop(count, seed):
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        # an object on black with some black speckles and a border of uneven width
+        height, width = rng.integers(60, 160, 2)
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        y0, x0 = rng.integers(0, 20, 2)
+        y1, x1 = height - rng.integers(0, 20), width - rng.integers(0, 20)
+        image[y0:y1, x0:x1] = rng.integers(1, 256, (y1 - y0, x1 - x0, 3))
+        image[rng.random((height, width)) < 0.02] = 0
+        y_top, y_bot, x_top, x_bot = reference_twoside_crop(image)
+        cropped = ImageCrop.iterative_twoside_crop(image, 1, 50, 0.0)
+        if cropped.shape != (y_bot - y_top, x_bot - x_top, 3) or not np.array_equal(
+            cropped, image[y_top:y_bot, x_top:x_bot]
+        ):
+            yield "iterative_twoside_crop differs for image #{}".format(i)
+        if crop_box(image, ImageCrop.get_largest_component_bbox(image)) != crop_box(
+            image, ImageCrop.get_largest_bbox(image)
+        ):
+            yield "get_largest_component_bbox differs for image #{}".format(i)
+        if crop_box(image, ImageCrop.get_largest_component_bbox(image, 0.25)) != crop_box(
+            image, ImageCrop.get_largest_bbox(image)
+        ):
+            yield "get_largest_component_bbox with scale 0.25 differs for image #{}".format(i)
+
+        # an elliptic object among non black speckles, which must not join into one blob
+        # when downscaled (at full size speckles touching the object join it)
+        size = 400
+        speckled = np.zeros((size, size, 3), dtype=np.uint8)
+        y0, x0 = rng.integers(20, 100, 2)
+        y1, x1 = size - rng.integers(20, 100, 2)
+        yy, xx = np.mgrid[:size, :size]
+        inside = ((2 * yy - y0 - y1 + 1) / (y1 - y0)) ** 2 + ((2 * xx - x0 - x1 + 1) / (x1 - x0)) ** 2 <= 1
+        speckled[inside] = rng.integers(1, 256, 3)
+        speckles = rng.random((size, size)) < 0.05
+        speckled[speckles] = rng.integers(1, 256, (int(speckles.sum()), 3))
+        rows, columns = np.flatnonzero(inside.any(axis=1)), np.flatnonzero(inside.any(axis=0))
+        object_box = (int(rows[0]), int(columns[0]), int(rows[-1]) + 1, int(columns[-1]) + 1)
+        scaled_box = component_box(speckled, 0.25)
+        if np.abs(np.subtract(object_box, scaled_box)).max() > 2:
+            yield "get_largest_component_bbox with scale 0.25 is off for speckled image #{}: {} instead of {}".format(
+                i, scaled_box, object_box
+            )
+
+
+def check_nearest_color(count, seed):
+    colors = np.random.default_rng(seed).integers(0, 256, (count * 20, 3)).tolist()
+    # grays and colors near the achromatic thresholds
+    colors += [[v, v, v] for v in range(0, 256, 3)]
+    colors += [[v, v + 5, v - 4] for v in (36, 61, 131, 169, 229, 241)]
+    color_lut = build_color_lut(color_list)
+    for color in colors:
+        expected = reference_nearest_color(color, color_list)
+        if get_nearest_color([color], color_list) != expected:
+            yield "get_nearest_color differs for {}".format(color)
+        if get_nearest_color([color], color_list, color_lut=color_lut) != expected:
+            yield "get_nearest_color with a lookup table differs for {}".format(color)
+
+
+def main(images, seed):
+    failures = 0
+    checks = (
+        check_color_cube,
+        check_filter_distinct_maxima,
+        check_crop,
+        check_nearest_color,
+    )
+    for check in checks:
+        messages = list(check(images, seed))
+        for message in messages:
+            print(message, file=sys.stderr)
+        print("{:30} {}".format(check.__name__, "FAILED" if messages else "ok"))
+        failures += len(messages)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the color pipeline against the original algorithms")
+    parser.add_argument("--images", default=12, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    sys.exit(main(**vars(parser.parse_args())))
@@ -1,47 +1,42 @@
 import argparse
+import cv2
 from shutil import copy
-from PIL import Image
 from pathlib import Path
 
 from colorcube.colorcube import ColorCube
-from config.constants import color_list, ACCEPTED_IMAGE_EXTENTIONS
+from config.constants import color_list
 from utils.color_functions import *
+from utils.file_functions import iter_image_paths
 from crop.imagecrop import ImageCrop
 
 
-def main(input_dir, output_dir, crop, min_side_length, image_resize):
+def main(input_dir, output_dir, crop, min_side_length, image_resize, recursive=False):
     input_dir = Path(input_dir)
     output_dir = Path(output_dir)
     image_cropper = ImageCrop(min_side_length)
 
     # read images from each of the classes dirs
     # for subdir in MASKED_SUBDIRS:
-    images = [
-        image_path
-        for ext in ACCEPTED_IMAGE_EXTENTIONS
-        for image_path in Path(input_dir).glob(ext)
-    ]
+    images = iter_image_paths(input_dir, recursive=recursive)
 
     make_color_dir_heirarchy(output_dir, color_list)
 
     # Create color cube, avoiding resulting colors that are too close to black.
     # note: this doesnt avoid these colors, just ignores them at the end!!
-    color_cube = ColorCube(avoid_color=[0.0, 0.0, 0.0])
+    color_cube = ColorCube(avoid_color=[0.0, 0.0, 0.0], channel_order="bgr")
     image_cropper = ImageCrop(min_side_length)
 
     for image_path in images:
         # Load image and scale down to make the algorithm faster.
         # Scaling down also gives colors that are more dominant in perception.
-        image_name = image_path.name
         image = cv2.imread(str(image_path))
 
         # get cropped image
         if crop:
             image = image_cropper.crop_image(image)
         if image is not None:
-            # resize image to image_resizeximage_resize and change to PIL for colorcube
+            # resize image to image_resizeximage_resize, colorcube reads the BGR pixels directly
             image = cv2.resize(image, (image_resize, image_resize))
-            image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
             # Get colors for image
             colors = color_cube.get_colors(image)
             if colors:
@@ -49,7 +44,7 @@ def main(input_dir, output_dir, crop, min_side_length, image_resize):
                 color_name = get_nearest_color(colors, color_list)
                 # try to save image
                 try:
-                    copy(input_dir / image_name, output_dir / color_name)
+                    copy(image_path, output_dir / color_name)
                 except Exception as e:
                     print(e)
 
@@ -82,5 +77,10 @@ if __name__ == "__main__":
         type=int,
         help="size of resized image to pass through color cube",
     )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="also read images from subdirectories of input_dir",
+    )
     args = parser.parse_args()
     main(**vars(args))
@@ -1,9 +1,12 @@
-import cv2
+import hashlib
 import math
 import numpy as np
+import os
 from enum import IntEnum
 from pathlib import Path
 
+from colorcube.lab import rgb_to_lab
+
 
 class AchromaticColorIndex(IntEnum):
     Black = 144
@@ -12,6 +15,79 @@ class AchromaticColorIndex(IntEnum):
     DarkGrey = 147
 
 
+# palettes with at least this many colors are searched with a KD-tree if SciPy is installed
+KDTREE_MIN_PALETTE_SIZE = 1024
+
+# color spaces colors can be matched to the palette in
+COLOR_SPACES = ("rgb", "lab")
+
+# RGB arrays and matchers of the color lists seen so far, keyed by id of the list
+_palette_cache = {}
+_matcher_cache = {}
+
+
+class PaletteMatcher(object):
+    """
+    Find the closest palette colors for many colors at once
+        Distances are euclidean in the color space of palette (RGB or CIELAB, see
+        munsell_matcher). They are computed in blocks of block_size colors with NumPy,
+        or with a KD-tree for large palettes
+    """
+
+    def __init__(
+        self, palette, names=None, kdtree_min_size=KDTREE_MIN_PALETTE_SIZE, block_size=4096
+    ):
+        self.palette = np.asarray(palette, dtype=np.float64).reshape(-1, 3)
+        self.names = names
+        self.block_size = block_size
+        self.squared_norms = np.sum(self.palette * self.palette, axis=1)
+        self.kdtree = None
+        if len(self.palette) >= kdtree_min_size:
+            try:
+                from scipy.spatial import cKDTree
+            except ImportError:
+                pass
+            else:
+                self.kdtree = cKDTree(self.palette)
+
+    def query(self, colors, k=1):
+        """
+        Return the indices and distances of the k closest palette colors of each color
+            colors is a M x 3 array, both results are M x k arrays with the closest
+            palette color first (ties go to the lower palette index)
+        """
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        k = min(k, len(self.palette))
+        if self.kdtree is not None:
+            distances, indices = self.kdtree.query(colors, k=k)
+            return indices.reshape(-1, k), distances.reshape(-1, k)
+
+        indices = np.empty((len(colors), k), dtype=np.intp)
+        distances = np.empty((len(colors), k), dtype=np.float64)
+        for start in range(0, len(colors), self.block_size):
+            block = colors[start : start + self.block_size]
+            # squared distances |c|^2 - 2 c.p + |p|^2, exact for 8 bit RGB colors.
+            # |c|^2 is the same for every palette color, so it is only added for the result
+            squared = self.squared_norms - 2.0 * block @ self.palette.T
+            if k == 1:
+                closest = np.argmin(squared, axis=1)[:, None]
+            else:
+                closest = np.argsort(squared, axis=1, kind="stable")[:, :k]
+            squared = np.take_along_axis(squared, closest, axis=1)
+            squared += np.sum(block * block, axis=1)[:, None]
+            indices[start : start + len(block)] = closest
+            distances[start : start + len(block)] = np.sqrt(np.maximum(squared, 0.0))
+        return indices, distances
+
+    def vote(self, colors, weights=None):
+        """
+        Return the palette index whose closest colors have the largest summed weight
+            weights (e.g. hit counts of the colors) default to 1 for each color
+        """
+        closest = self.query(colors)[0][:, 0]
+        return int(np.argmax(np.bincount(closest, weights=weights, minlength=len(self.palette))))
+
+
 def make_color_dir_heirarchy(output_dir, color_list):
     """ create the directory of color dirs for images to be placed in"""
     root_dir = Path(output_dir)
@@ -27,14 +103,136 @@ def is_color_gray(color, min_distance=10):
     )
 
 
-def get_nearest_color(colors, color_list, top_k_colors=1):
+def palette_rgb(color_list):
+    """
+    Return the RGB values of the colors in color_list as a (N, 3) float array
+        The strings of each color list are only parsed on the first call
+    """
+    cached = _palette_cache.get(id(color_list))
+    if cached is None or cached[0] is not color_list:
+        cached = (
+            color_list,
+            np.array([[float(value) for value in color[1:4]] for color in color_list]),
+        )
+        _palette_cache[id(color_list)] = cached
+    return cached[1]
+
+
+def munsell_matcher(color_list, color_space="rgb"):
+    """
+    Return the PaletteMatcher of color_list used by get_nearest_color, built on the first call
+        (the grays at the end of color_list are not matched)
+        With color_space lab the palette is converted to CIELAB, so the matcher
+        has to be queried with CIELAB colors (see palette_query)
+    """
+    assert color_space in COLOR_SPACES, "color_space must be one of {}".format(COLOR_SPACES)
+    key = (id(color_list), color_space)
+    cached = _matcher_cache.get(key)
+    if cached is None or cached[0] is not color_list:
+        palette = palette_rgb(color_list)[:-2]
+        if color_space == "lab":
+            palette = rgb_to_lab(palette)
+        matcher = PaletteMatcher(palette, names=[color[0] for color in color_list[:-2]])
+        cached = (color_list, matcher)
+        _matcher_cache[key] = cached
+    return cached[1]
+
+
+def palette_query(colors, color_list, color_space="rgb"):
+    """ return the index of the closest color group of color_list for each RGB color in colors """
+    if color_space == "lab":
+        colors = rgb_to_lab(colors)
+    return munsell_matcher(color_list, color_space).query(colors)[0][:, 0]
+
+
+def nearest_color_indices(colors, color_list, color_space="rgb"):
+    """
+    Return the index of the closest color of color_list for each RGB color in colors (M x 3)
+        Applies the same rules as get_nearest_color: black, white, light and dark grey
+        are assigned directly, every other color gets the closest color group by
+        distance in color_space (grays at the end of color_list excluded)
+    """
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+    indices = palette_query(colors, color_list, color_space)
+
+    low, high = colors.min(axis=1), colors.max(axis=1)
+    # largest pairwise component difference decides if a color is gray
+    gray = high - low < 10
+    indices[high <= 35] = AchromaticColorIndex.Black
+    indices[low > 240] = AchromaticColorIndex.White
+    indices[(low > 168) & (high < 230) & gray] = AchromaticColorIndex.LightGray
+    indices[(low > 60) & (high < 132) & gray] = AchromaticColorIndex.DarkGrey
+    return indices
+
+
+def build_color_lut(color_list, bits=8, color_space="rgb"):
+    """
+    Build a lookup table mapping RGB colors to the index of their closest color in color_list
+        The table has 2**bits entries per component and is indexed with
+        [r >> (8 - bits), g >> (8 - bits), b >> (8 - bits)]
+        With bits=8 every entry equals nearest_color_indices of that color,
+        with fewer bits the center of each quantization step is classified
+        color_space is passed on to nearest_color_indices
+    """
+    assert 1 <= bits <= 8, "bits must be between 1 and 8"
+    assert len(color_list) <= 256, "color_list has too many colors for a uint8 table"
+    size = 1 << bits
+    step = 1 << (8 - bits)
+    values = np.arange(size) * step + step // 2
+    green, blue = np.meshgrid(values, values, indexing="ij")
+    lut = np.empty((size, size, size), dtype=np.uint8)
+    # one red value at a time keeps the distance matrix small
+    for r_index, red in enumerate(values):
+        colors = np.stack((np.full(green.size, red), green.ravel(), blue.ravel()), axis=1)
+        lut[r_index] = nearest_color_indices(colors, color_list, color_space).reshape(
+            size, size
+        )
+    return lut
+
+
+def palette_hash(color_list):
+    """ hash of the names and values of color_list, changes whenever the palette changes """
+    return hashlib.sha1(repr([list(color) for color in color_list]).encode()).hexdigest()
+
+
+def color_lut_path(cache_dir, color_list, bits=8, color_space="rgb"):
+    """ path of the cached lookup table for color_list, changes whenever the palette changes """
+    # tables matching in RGB keep their original names
+    prefix = "color_lut" if color_space == "rgb" else "color_lut_" + color_space
+    return Path(cache_dir) / "{}_{}bit_{}.npy".format(
+        prefix, bits, palette_hash(color_list)[:16]
+    )
+
+
+def load_color_lut(cache_dir, color_list, bits=8, color_space="rgb"):
+    """
+    Return the lookup table for color_list from cache_dir, memory-mapped read only
+        so processes loading the same file share it
+        The table is built and saved to cache_dir first if it is not cached yet
+    """
+    path = color_lut_path(cache_dir, color_list, bits, color_space)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so readers never see a partial table
+        temp_path = path.with_suffix(".{}.tmp".format(os.getpid()))
+        with open(str(temp_path), "wb") as lut_file:
+            np.save(lut_file, build_color_lut(color_list, bits, color_space))
+        os.replace(str(temp_path), str(path))
+    return np.load(str(path), mmap_mode="r")
+
+
+def get_nearest_color(
+    colors, color_list, top_k_colors=1, color_lut=None, color_space="rgb"
+):
     """
     Given A set of colors, return the index of closest munsell color
         If colors is empty return None
         Else ret index of closest color
         If color close to black, white, or RGB colors < 10 away from each other
             Assign color and return
-        Closest found by comparing distances in RGB color space
+        Closest found by comparing distances in color_space, RGB or CIELAB
+        (the rules for black, white and greys always use RGB)
+        If color_lut (see build_color_lut) is given the index is read from the table
     """
     color_name = ""
     min_index = None
@@ -43,6 +241,13 @@ def get_nearest_color(colors, color_list, top_k_colors=1):
     # check if the color is either white, black, light grey or dark grey
     # if it is, then skip checking munsell colors and add this image to the dir
     for color in colors[:top_k_colors]:
+        if color_lut is not None:
+            # the table has 2**bits entries per component
+            shift = 8 - (color_lut.shape[0].bit_length() - 1)
+            min_index = int(
+                color_lut[color[0] >> shift, color[1] >> shift, color[2] >> shift]
+            )
+            continue
         # check black
         if color[0] <= 35 and color[1] <= 35 and color[2] <= 35:
             min_index = AchromaticColorIndex.Black
@@ -76,18 +281,10 @@ def get_nearest_color(colors, color_list, top_k_colors=1):
         if not min_index:
             # if not generic black, white, light/dark grey
             # find closest color group
-            distances = []
-            color = np.array((color[0], color[1], color[2]))
             # i do not exactly remember why -2.. regardless grays are not included
             # this means black and white can still be attributed if they are not assigned
             # above
-            for pccs_color in color_list[:-2]:
-                # index 0 is the name of the color
-                pccs_color = np.array(
-                    (int(pccs_color[1]), int(pccs_color[2]), int(pccs_color[3]))
-                )
-                distances.append(np.linalg.norm(color - pccs_color))
-            min_index = np.argmin(distances)
+            min_index = palette_query([color[:3]], color_list, color_space)[0]
     if min_index is not None:
         color_name = color_list[min_index][0]
     return color_name
@@ -0,0 +1,78 @@
+import cv2
+import io
+import numpy as np
+import os
+from pathlib import Path
+from PIL import Image
+
+from config.constants import ACCEPTED_IMAGE_EXTENTIONS
+
+# cv2.imread flags for decoding at reduced scale, largest reduction first
+REDUCED_COLOR_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def iter_image_paths(input_dir, extensions=ACCEPTED_IMAGE_EXTENTIONS, recursive=False):
+    """
+    Yield paths of the images in input_dir as the directory is scanned
+        Extensions are glob patterns like "*.jpg" and are matched case-insensitively,
+        so every file is looked at once no matter how many patterns are given
+        If recursive is set, subdirectories are scanned too (symlinked dirs are not followed)
+    """
+    suffixes = tuple({ext.lstrip("*").lower() for ext in extensions})
+    dirs = [Path(input_dir)]
+    while dirs:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(suffixes):
+                    yield Path(entry.path)
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    dirs.append(Path(entry.path))
+
+
+def read_image(image_path, min_side_length=None):
+    """
+    Read the image at image_path as BGR array like cv2.imread
+        If min_side_length is given, JPEGs are decoded at 1/2, 1/4 or 1/8 scale,
+        whichever is the largest reduction that keeps the shorter side
+        at least min_side_length pixels long. JPEG decoders can skip most
+        of the work for these scales, other formats are always read in full
+    """
+    flags = decode_flags(str(image_path), min_side_length)
+    return cv2.imread(str(image_path), flags)
+
+
+def decode_image(image_data, min_side_length=None):
+    """
+    Decode the bytes of an image file like read_image reads the file (None if it can't be decoded)
+    """
+    if not image_data:
+        return None
+    flags = decode_flags(io.BytesIO(image_data), min_side_length)
+    return cv2.imdecode(np.frombuffer(image_data, np.uint8), flags)
+
+
+def decode_flags(image_file, min_side_length=None):
+    """
+    cv2 flags to decode image_file (a path or file object) with, see read_image
+    """
+    flags = cv2.IMREAD_COLOR
+    if min_side_length:
+        try:
+            # only reads the header
+            with Image.open(image_file) as image:
+                is_jpeg = image.format == "JPEG"
+                shorter_side = min(image.size)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            # decoded in full like cv2.imread does, PIL refuses to open images
+            # of more than 2 * Image.MAX_IMAGE_PIXELS pixels
+            is_jpeg = False
+        if is_jpeg:
+            for factor, reduced_flags in REDUCED_COLOR_FLAGS:
+                if shorter_side // factor >= min_side_length:
+                    flags = reduced_flags
+                    break
+    return flags
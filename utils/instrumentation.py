@@ -0,0 +1,236 @@
+import json
+import os
+import sys
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# upper bounds in seconds of the latency histogram buckets (the last bucket is unbounded)
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class _NoStage(object):
+    # context manager that does nothing, shared by all disabled stages
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NO_STAGE = _NoStage()
+
+
+class NullStats(object):
+    """
+    Stand-in for PipelineStats when instrumentation is disabled, every call is a no-op
+    """
+
+    enabled = False
+
+    def stage(self, name):
+        return NO_STAGE
+
+    def record(self, name, seconds):
+        pass
+
+    def record_all(self, timings):
+        pass
+
+    def pop_timings(self):
+        return ()
+
+    def image_done(self, bytes_read=0, bytes_written=0):
+        pass
+
+    def add_bytes_written(self, byte_count):
+        pass
+
+
+NULL_STATS = NullStats()
+
+
+class StageTimer(object):
+    """
+    Collects (stage, seconds) pairs, e.g. in a worker process until they are sent to the parent
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.timings = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.timings.append((name, seconds))
+
+    def record_all(self, timings):
+        for name, seconds in timings:
+            self.record(name, seconds)
+
+    def pop_timings(self):
+        """ return the timings recorded so far and start over """
+        timings, self.timings = self.timings, []
+        return timings
+
+
+class PipelineStats(StageTimer):
+    """
+    Per-stage latency histograms and throughput of a pipeline run
+        Prints a progress line every progress_interval seconds (never if None)
+        and can write a summary as JSON or as Prometheus textfile
+    """
+
+    def __init__(self, progress_interval=10.0, out=sys.stderr):
+        super().__init__()
+        self.progress_interval = progress_interval
+        self.out = out
+        self.start_time = time.perf_counter()
+        self.last_progress = self.start_time
+        self.images = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        # stage name -> [count, total seconds, bucket counts]
+        self.stages = {}
+
+    def record(self, name, seconds):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+        stage[0] += 1
+        stage[1] += seconds
+        stage[2][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def image_done(self, bytes_read=0, bytes_written=0):
+        self.images += 1
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        if self.progress_interval is not None:
+            now = time.perf_counter()
+            if now - self.last_progress >= self.progress_interval:
+                self.last_progress = now
+                print(self.progress_line(), file=self.out)
+
+    def add_bytes_written(self, byte_count):
+        # for writes that are not done per image, e.g. batched copies
+        self.bytes_written += byte_count
+
+    def progress_line(self):
+        elapsed = time.perf_counter() - self.start_time
+        return "{} images in {:.1f}s ({:.1f} images/s), {:.1f} MB read, {:.1f} MB written".format(
+            self.images,
+            elapsed,
+            self.images / elapsed if elapsed else 0.0,
+            self.bytes_read / 1e6,
+            self.bytes_written / 1e6,
+        )
+
+    @staticmethod
+    def quantile(buckets, count, q):
+        # upper bound of the bucket holding the q-quantile
+        seen = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+            seen += bucket_count
+            if seen >= q * count:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            "images": self.images,
+            "seconds": elapsed,
+            "images_per_second": self.images / elapsed if elapsed else 0.0,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "stages": {
+                name: {
+                    "count": count,
+                    "total_seconds": total,
+                    "mean_seconds": total / count,
+                    "p50_seconds": self.quantile(buckets, count, 0.5),
+                    "p95_seconds": self.quantile(buckets, count, 0.95),
+                    "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], buckets)),
+                }
+                for name, (count, total, buckets) in self.stages.items()
+            },
+        }
+
+    def print_summary(self):
+        print(self.progress_line(), file=self.out)
+        print(
+            "{:14} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+                "stage", "count", "total s", "mean ms", "p50 ms", "p95 ms"
+            ),
+            file=self.out,
+        )
+        stages = sorted(self.summary()["stages"].items(), key=lambda s: -s[1]["total_seconds"])
+        for name, stage in stages:
+            print(
+                "{:14} {:8d} {:10.3f} {:10.3f} {:>10} {:>10}".format(
+                    name,
+                    stage["count"],
+                    stage["total_seconds"],
+                    stage["mean_seconds"] * 1000,
+                    "<={:g}".format(stage["p50_seconds"] * 1000),
+                    "<={:g}".format(stage["p95_seconds"] * 1000),
+                ),
+                file=self.out,
+            )
+
+    def write_json(self, path):
+        with open(str(path), "w") as json_file:
+            json.dump(self.summary(), json_file, indent=2)
+
+    def write_prometheus(self, path, prefix="color_pipeline"):
+        """ write all metrics in the Prometheus textfile format (e.g. for the node exporter) """
+        lines = [
+            "# TYPE {}_stage_seconds histogram".format(prefix),
+        ]
+        for name, (count, total, buckets) in sorted(self.stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket_count
+                lines.append(
+                    '{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                        prefix, name, bound, cumulative
+                    )
+                )
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(prefix, name, total))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, count))
+        for metric, value in (
+            ("images_total", self.images),
+            ("bytes_read_total", self.bytes_read),
+            ("bytes_written_total", self.bytes_written),
+        ):
+            lines.append("# TYPE {}_{} counter".format(prefix, metric))
+            lines.append("{}_{} {}".format(prefix, metric, value))
+        # write next to the target and rename, so scrapers never read a partial file
+        temp_path = "{}.tmp".format(path)
+        with open(temp_path, "w") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, str(path))
@@ -0,0 +1,108 @@
+import csv
+import json
+from pathlib import Path
+
+MANIFEST_FORMATS = ("csv", "jsonl", "parquet")
+
+
+class ManifestWriter(object):
+    """
+    Streams classification results (path, label, top colors and their hit counts) to a file
+        manifest_format:
+            csv - one row per image, columns path, label and color_<i>_r/g/b/hits for the top_k colors
+            jsonl - one JSON object per line with lists of colors and hit_counts
+            parquet - same columns as jsonl, one row group per buffer (needs pyarrow)
+        Rows are buffered and written buffer_size at a time
+    """
+
+    def __init__(self, path, manifest_format="csv", top_k=5, buffer_size=1024):
+        assert manifest_format in MANIFEST_FORMATS, "manifest_format must be one of {}".format(
+            MANIFEST_FORMATS
+        )
+        self.path = Path(path)
+        self.manifest_format = manifest_format
+        self.top_k = top_k
+        self.buffer_size = buffer_size
+        self.rows = []
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.parquet_writer = None
+        self.file = None
+        if manifest_format == "parquet":
+            # pyarrow takes long to import, only parquet manifests need it
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError("parquet manifests need pyarrow, install it or use csv or jsonl")
+            self.pyarrow = pyarrow
+            self.schema = pyarrow.schema(
+                [
+                    ("path", pyarrow.string()),
+                    ("label", pyarrow.string()),
+                    ("colors", pyarrow.list_(pyarrow.list_(pyarrow.uint8(), 3))),
+                    ("hit_counts", pyarrow.list_(pyarrow.int64())),
+                ]
+            )
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(str(self.path), self.schema)
+            return
+        self.file = open(str(self.path), "w", newline="")
+        if manifest_format == "csv":
+            self.csv_writer = csv.writer(self.file)
+            header = ["path", "label"]
+            for i in range(1, top_k + 1):
+                header += ["color_{}_{}".format(i, c) for c in ("r", "g", "b", "hits")]
+            self.csv_writer.writerow(header)
+
+    def write(self, image_path, label, colors, hit_counts):
+        """ add the result of one image, only the first top_k colors are kept """
+        self.rows.append(
+            (str(image_path), label, colors[: self.top_k], hit_counts[: self.top_k])
+        )
+        if len(self.rows) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ write the buffered rows """
+        if not self.rows:
+            return
+        if self.manifest_format == "csv":
+            lines = []
+            for path, label, colors, hit_counts in self.rows:
+                line = [path, label]
+                for color, hits in zip(colors, hit_counts):
+                    line += [color[0], color[1], color[2], hits]
+                # images with less than top_k colors get empty columns
+                line += [""] * (2 + 4 * self.top_k - len(line))
+                lines.append(line)
+            self.csv_writer.writerows(lines)
+        elif self.manifest_format == "jsonl":
+            self.file.write(
+                "".join(
+                    json.dumps(
+                        {
+                            "path": path,
+                            "label": label,
+                            "colors": colors,
+                            "hit_counts": hit_counts,
+                        }
+                    )
+                    + "\n"
+                    for path, label, colors, hit_counts in self.rows
+                )
+            )
+        else:
+            paths, labels, colors, hit_counts = zip(*self.rows)
+            self.parquet_writer.write_table(
+                self.pyarrow.table(
+                    [list(paths), list(labels), list(colors), list(hit_counts)],
+                    schema=self.schema,
+                )
+            )
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+        else:
+            self.file.close()
@@ -0,0 +1,158 @@
+import errno
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from utils.instrumentation import NULL_STATS
+
+try:
+    import fcntl
+except ImportError:
+    # no reflinks on this platform, they fall back to copies
+    fcntl = None
+
+OUTPUT_MODES = ("copy", "hardlink", "symlink", "reflink", "move", "manifest-only")
+
+# ioctl request of linux to share the data blocks of a file (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors of a link or reflink that mean the file has to be copied instead
+LINK_FALLBACK_ERRORS = (
+    errno.EXDEV,
+    errno.EPERM,
+    errno.EMLINK,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EBADF,
+)
+
+
+def reflink(source, destination):
+    """
+    create destination as copy-on-write clone of source, raises OSError if the filesystem can't
+    """
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform")
+    with open(str(source), "rb") as source_file, open(
+        str(destination), "wb"
+    ) as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copymode(str(source), str(destination))
+
+
+class OutputWriter(object):
+    """
+    Places classified images into the output dirs
+        mode is one of OUTPUT_MODES:
+            copy, move - like shutil.copy and shutil.move
+            hardlink, symlink, reflink - no file data is written, a copy is made instead
+            where the link is not possible (e.g. across filesystems)
+            manifest-only - no files are placed, results go to a manifest (see utils.manifest)
+        Operations are queued and run in batches of batch_size, sorted by destination dir
+        so each dir gets its entries in one go. Deletions queued with remove run after the
+        files of their batch were placed. Up to writers files of a batch are placed at a time
+        stats times each batch as output stage and counts the bytes copied
+        Files can be placed under a relative path, its subdirs are created as needed
+    """
+
+    def __init__(self, mode="copy", batch_size=256, writers=1, stats=NULL_STATS):
+        assert mode in OUTPUT_MODES, "mode must be one of {}".format(OUTPUT_MODES)
+        self.mode = mode
+        self.batch_size = batch_size
+        self.pool = ThreadPoolExecutor(writers) if writers > 1 else None
+        self.stats = stats
+        self.placements = []
+        self.removals = []
+        # (source dir, destination dir) pairs that can't be linked, copied right away
+        self.unlinkable = set()
+        # subdirs of the destination dirs created so far
+        self.made_dirs = set()
+
+    def add(self, source, destination_dir, name=None):
+        """
+        queue placing the file at source into destination_dir
+            name is the path of the file relative to destination_dir, the name of source by default
+        """
+        if self.mode == "manifest-only":
+            return
+        source = Path(source)
+        destination = Path(destination_dir) / (name or source.name)
+        self.placements.append((destination, source))
+        if len(self.placements) >= self.batch_size:
+            self.flush()
+
+    def remove(self, path):
+        """ queue deleting the file at path once the queued files were placed """
+        self.removals.append(Path(path))
+        if len(self.removals) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ run all queued operations """
+        if not self.placements and not self.removals:
+            return
+        with self.stats.stage("output"):
+            self.placements.sort(key=lambda placement: str(placement[0].parent))
+            self.make_dirs(self.placements)
+            if self.pool is None:
+                copied = sum(self.try_place(placement) for placement in self.placements)
+            else:
+                copied = sum(self.pool.map(self.try_place, self.placements))
+            self.stats.add_bytes_written(copied)
+            self.placements = []
+            for path in self.removals:
+                path.unlink()
+            self.removals = []
+
+    def make_dirs(self, placements):
+        """ create the subdirs placements go to, once for all batches """
+        for destination, _ in placements:
+            if destination.parent not in self.made_dirs:
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                self.made_dirs.add(destination.parent)
+
+    def try_place(self, placement):
+        destination, source = placement
+        try:
+            return self.place(source, destination)
+        except Exception as e:
+            print(e)
+            return 0
+
+    def place(self, source, destination):
+        """ place the file at source at destination, returns the number of bytes copied """
+        if self.mode == "move":
+            shutil.move(str(source), str(destination))
+            return 0
+        # replace existing files, never write through a link left by an earlier run
+        if os.path.lexists(str(destination)):
+            destination.unlink()
+        if self.mode != "copy":
+            dirs = (source.parent, destination.parent)
+            if dirs not in self.unlinkable:
+                try:
+                    self.link(source, destination)
+                    return 0
+                except OSError as e:
+                    if e.errno not in LINK_FALLBACK_ERRORS:
+                        raise
+                    self.unlinkable.add(dirs)
+        shutil.copy(str(source), str(destination))
+        return destination.stat().st_size if self.stats.enabled else 0
+
+    def link(self, source, destination):
+        if self.mode == "reflink":
+            reflink(source, destination)
+        elif self.mode == "hardlink":
+            os.link(str(source), str(destination))
+        else:
+            os.symlink(str(source.resolve()), str(destination))
+
+    def close(self):
+        """ run the remaining operations """
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+
+# read files in chunks of this size when hashing their content
+HASH_CHUNK_SIZE = 1 << 20
+
+# stored with the settings, databases with results of another format are emptied
+RESULT_FORMAT = 2
+
+
+class ResultCache(object):
+    """
+    On-disk cache of classification results in a SQLite database
+        Results are keyed by file (see key) and only valid for the settings they were
+        computed with: settings is a dict of everything that changes results (color cube
+        and crop parameters, palette hash, ...). If the database was written with other
+        settings, all cached results are dropped when it is opened
+        At most max_entries results are kept, the least recently used ones are evicted first
+    """
+
+    def __init__(
+        self, path, settings, max_entries=1000000, key_mode="stat", commit_every=100
+    ):
+        assert key_mode in ("stat", "content"), "key_mode must be stat or content"
+        self.key_mode = key_mode
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.pending_writes = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS settings (settings TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                colors TEXT,
+                color_name TEXT,
+                last_used INTEGER NOT NULL,
+                hit_counts TEXT
+            );
+            CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+            """
+        )
+        settings = json.dumps(dict(settings, result_format=RESULT_FORMAT), sort_keys=True)
+        row = self.connection.execute("SELECT settings FROM settings").fetchone()
+        if row is None or row[0] != settings:
+            # results computed with other settings are stale
+            columns = [c[1] for c in self.connection.execute("PRAGMA table_info(results)")]
+            if "hit_counts" not in columns:
+                # table of the first format
+                self.connection.execute("ALTER TABLE results ADD COLUMN hit_counts TEXT")
+            self.connection.execute("DELETE FROM results")
+            self.connection.execute("DELETE FROM settings")
+            self.connection.execute("INSERT INTO settings VALUES (?)", (settings,))
+            self.connection.commit()
+        # recency counter, continues where the last run stopped
+        row = self.connection.execute("SELECT MAX(last_used) FROM results").fetchone()
+        self.clock = row[0] or 0
+
+    def key(self, image_path):
+        """
+        cache key of the file at image_path
+            stat: absolute path, size and modification time (no file reads)
+            content: hash of the file content, survives renames and copies
+        """
+        image_path = Path(image_path)
+        if self.key_mode == "content":
+            digest = hashlib.blake2b(digest_size=20)
+            with open(str(image_path), "rb") as image_file:
+                for chunk in iter(lambda: image_file.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        stat = image_path.stat()
+        return "{}|{}|{}".format(image_path.resolve(), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, key):
+        """ return the cached (colors, color_name, hit_counts) for key or None if there is none """
+        row = self.connection.execute(
+            "SELECT colors, color_name, hit_counts FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.clock += 1
+        self.connection.execute(
+            "UPDATE results SET last_used = ? WHERE key = ?", (self.clock, key)
+        )
+        self._written()
+        colors, color_name, hit_counts = row
+        return (
+            json.loads(colors) if colors is not None else None,
+            color_name,
+            json.loads(hit_counts) if hit_counts is not None else None,
+        )
+
+    def put(self, key, colors, color_name, hit_counts):
+        """ cache the result of an image, all values may be None for rejected images """
+        self.clock += 1
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results "
+            "(key, colors, color_name, last_used, hit_counts) VALUES (?, ?, ?, ?, ?)",
+            (
+                key,
+                json.dumps(colors) if colors is not None else None,
+                color_name,
+                self.clock,
+                json.dumps(hit_counts) if hit_counts is not None else None,
+            ),
+        )
+        self._written()
+
+    def _written(self):
+        # commit and evict in batches, not on every single write
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """ evict least recently used results above max_entries and write everything to disk """
+        self.connection.execute(
+            "DELETE FROM results WHERE key IN ("
+            "SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()